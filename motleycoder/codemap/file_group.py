@@ -1,19 +1,43 @@
+import bisect
+import itertools
 import logging
 import os
 import os.path
 import re
-from collections import defaultdict
+import stat
+import tempfile
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, suppress
 from difflib import SequenceMatcher
+from functools import partial
 from pathlib import Path
-from typing import Callable, List, Set, Optional
+from typing import Any, Callable, Dict, Iterator, List, Set, Optional, Tuple
 
 from diskcache import Cache
 
+try:
+    from rapidfuzz.distance import Indel
+except ImportError:
+    Indel = None
+
 from motleycoder.repo import GitRepo
 
+_LINE_NUM_RE = re.compile(r"^\d+\s*│")
+_DOTS_RE = re.compile(r"(^\s*\.\.\.\n)", re.MULTILINE | re.DOTALL)
+_WORD_RE = re.compile(r"\w+")
+
+# Directories that never contain files of interest when walking a plain directory tree
+IGNORED_DIRS = frozenset({".git", "__pycache__", ".venv", "node_modules"})
+
+_QUOTE_CHARS = "\"'`"
+_FNAME_SEP_CHARS = frozenset("/._-")
+
 
 def python_file_filter(fname: str, with_tests: bool = False) -> bool:
-    return fname.endswith(".py") and (with_tests or not "test_" in fname)
+    base = fname.rsplit("/", 1)[-1]
+    return base.endswith(".py") and (with_tests or not base.startswith("test_"))
 
 
 class FileGroup:
@@ -23,8 +47,9 @@ class FileGroup:
     we will see that as well using the get_all_filenames method.
     """
 
-    CACHE_VERSION = 4
-    TAGS_CACHE_DIR = f".aider.tags.cache.v{CACHE_VERSION}"
+    CACHE_VERSION = 7
+    TAGS_CACHE_DIR_PREFIX = ".aider.tags.cache"
+    TAGS_CACHE_DIR = f"{TAGS_CACHE_DIR_PREFIX}.v{CACHE_VERSION}"
 
     def __init__(self, repo: GitRepo | None = None, root: str | None = None, filename_filter=None):
         # TODO: support other kinds of locations
@@ -36,76 +61,214 @@ class FileGroup:
                 raise ValueError("Must supply either a GitRepo or a valid root directory")
         else:
             self.root = self.repo.root
+        self._root_abs = str(Path(self.root).resolve())
+        self._root_norm = os.path.abspath(self.root)
+        self._rel_fname_cache: dict[str, str] = {}
 
         if filename_filter is None:
             self.filename_filter = python_file_filter
         else:
             self.filename_filter = filename_filter
-
-        self.load_tags_cache()
+        # Bind with_tests once, so hot loops don't pass the keyword on every call
+        self._filename_filters = {
+            with_tests: partial(self.filename_filter, with_tests=with_tests)
+            for with_tests in (False, True)
+        }
+
+        self._tags_cache: Cache | None = None
+        self._mem_cache: dict[str, tuple[float, Any]] = {}
+        self._content_cache: dict[str, tuple[tuple[int, int], str]] = {}
         self.warned_files = set()
 
-        self.files_for_modification = set()
+        # The set and the sorted files, swapped together for new ones on every addition,
+        # so readers never see them change under them or disagree
+        self._files_for_modification: tuple[frozenset[str], tuple[str, ...]] = (frozenset(), ())
+        # Edits to different files may add them concurrently, see FileEditTool.edit_files
+        self._modification_lock = threading.Lock()
         self.edited_files = set()
 
-    def abs_root_path(self, path):
-        "Gives an abs path, which safely returns a full (not 8.3) windows path"
-        res = Path(self.root) / path
-        res = Path(res).resolve()
-        return str(res)
+        self._all_files_cache: dict[bool, tuple[Any, Tuple[str, ...], frozenset[str]]] = {}
+        # The directories seen by the last walk of a group that's not a git repo
+        self._walked_dirs: Tuple[str, ...] = ()
+        self._basename_index: tuple[List[str], Dict[str, List[str]]] | None = None
+        self._dir_index: tuple[List[str], Dict[str, List[str]]] | None = None
 
-    def get_all_filenames(self, with_tests: bool = False):
+    def abs_root_path(self, path, resolve_symlinks: bool = False):
         """
-        Get all the filenames in the group, including new files.
-        :return: List of unique absolute file paths
+        Gives an abs path, which safely returns a full (not 8.3) windows path.
+        The root is resolved once, the path is joined to it with plain string operations;
+        pass resolve_symlinks=True to also resolve symlinks inside the group.
+        """
+        if resolve_symlinks:
+            return str((Path(self.root) / path).resolve())
+        return os.path.normpath(os.path.join(self._root_abs, path))
+
+    def get_files_signature(self):
+        """
+        A cheap stamp that changes whenever the list of files in the group might have changed.
+        For git repos, this is based on HEAD and the index; otherwise, on the mtimes of all the
+        directories seen by the last walk, as adding or removing a file only changes the mtime
+        of the directory it is in.
         """
         if self.repo:
-            files = self.repo.get_tracked_files()
-            files = [self.abs_root_path(fname) for fname in files]
-            files = [str(fname) for fname in files if os.path.isfile(str(fname))]
+            return self.repo.get_tracked_files_signature()
+        return self._dir_stamps(self._walked_dirs)
 
-        else:
-            files = [str(f) for f in Path(self.root).rglob("*") if f.is_file()]
+    @staticmethod
+    def _dir_stamps(dirs: Tuple[str, ...]) -> Tuple[Tuple[str, int], ...] | None:
+        try:
+            return tuple((d, os.stat(d).st_mtime_ns) for d in dirs)
+        except OSError:
+            # A directory is gone, the files have changed for sure
+            return None
+
+    def _is_signature_current(self, signature) -> bool:
+        if self.repo:
+            return signature == self.get_files_signature()
+        # Each listing carries the directories of its own walk
+        return signature == self._dir_stamps(tuple(d for d, _ in signature))
+
+    def invalidate_file_cache(self):
+        self._all_files_cache.clear()
 
-        files = [
-            str(f).replace("\\", "/")
-            for f in files
-            if self.filename_filter(f, with_tests=with_tests)
-        ]
+    def get_all_filenames(self, with_tests: bool = False) -> Tuple[str, ...]:
+        """
+        Get all the filenames in the group, including new files.
+        The result is cached until the group's files signature changes.
+        :return: Sorted tuple of unique absolute file paths
+        """
+        return self._get_all_files_entry(with_tests)[1]
+
+    def get_all_filenames_set(self, with_tests: bool = False) -> frozenset[str]:
+        """
+        Same as get_all_filenames, as a frozenset for membership tests and set algebra.
+        """
+        return self._get_all_files_entry(with_tests)[2]
+
+    def _get_all_files_entry(
+        self, with_tests: bool
+    ) -> tuple[Any, Tuple[str, ...], frozenset[str]]:
+        cached = self._all_files_cache.get(with_tests)
+        if cached is not None and self._is_signature_current(cached[0]):
+            return cached
+
+        if self.repo:
+            signature = self.get_files_signature()
+            files = set(self.iter_all_filenames(with_tests))
+        else:
+            # The directory mtimes are taken as the walk goes, before listing each directory
+            dirs = []
+            flt = self._filename_filters[with_tests]
+            files = set(self._scandir_recursive(str(self.root), flt, dirs))
+            signature = tuple(dirs)
+            self._walked_dirs = tuple(d for d, _ in dirs)
+
+        entry = (signature, tuple(sorted(files)), frozenset(files))
+        self._all_files_cache[with_tests] = entry
+        return entry
+
+    def iter_all_filenames(self, with_tests: bool = False) -> Iterator[str]:
+        """
+        Yield the absolute paths of all the files in the group, unsorted and uncached.
+        Use get_all_filenames or get_all_filenames_set unless a fresh listing is needed.
+        """
+        flt = self._filename_filters[with_tests]
+        if self.repo:
+            absr = self.abs_root_path
+            for fname in self.repo.get_tracked_files():
+                path = absr(fname).replace("\\", "/")
+                # Filter by name first: that's free, while isfile is a stat call
+                if flt(path) and os.path.isfile(path):
+                    yield path
+        else:
+            yield from self._scandir_recursive(str(self.root), flt)
 
-        return sorted(set(files))
+    def _scandir_recursive(
+        self,
+        path: str,
+        flt: Callable[[str], bool],
+        dirs: Optional[List[Tuple[str, int]]] = None,
+    ) -> Iterator[str]:
+        """
+        Walk a directory tree with os.scandir, which caches the entry types from readdir,
+        so no extra stat calls are needed for most entries.
+        Directories in IGNORED_DIRS and tags cache directories are pruned without being entered.
+        If dirs is given, the walked directories and their mtimes are appended to it.
+        """
+        if dirs is not None:
+            dirs.append((path, os.stat(path).st_mtime_ns))
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_file():
+                    fname = entry.path.replace("\\", "/")
+                    if flt(fname):
+                        yield fname
+                elif entry.is_dir(follow_symlinks=False) and not self._is_ignored_dir(entry.name):
+                    yield from self._scandir_recursive(entry.path, flt, dirs)
+
+    def _is_ignored_dir(self, name: str) -> bool:
+        return name in IGNORED_DIRS or name.startswith(self.TAGS_CACHE_DIR_PREFIX)
 
     def validate_fnames(self, fnames: List[str], with_tests: bool = False) -> List[str]:
         cleaned_fnames = []
+        flt = self._filename_filters[with_tests]
         for fname in fnames:
-            if not self.filename_filter(str(fname), with_tests=with_tests):
+            if not flt(str(fname)):
                 continue
-            if Path(fname).is_file():
+            # One stat call tells both whether it's a regular file and whether it exists at all
+            try:
+                mode = os.stat(fname).st_mode
+            except OSError:
+                mode = None
+            if mode is not None and stat.S_ISREG(mode):
                 cleaned_fnames.append(str(fname))
-            else:
-                if fname not in self.warned_files:
-                    if Path(fname).exists():
-                        logging.error(f"Repo-map can't include {fname}, it is not a normal file")
-                    else:
-                        logging.error(
-                            f"Repo-map can't include {fname}, it doesn't exist (anymore?)"
-                        )
+            elif fname not in self.warned_files:
+                if mode is not None:
+                    logging.error(f"Repo-map can't include {fname}, it is not a normal file")
+                else:
+                    logging.error(f"Repo-map can't include {fname}, it doesn't exist (anymore?)")
 
                 self.warned_files.add(fname)
 
         return cleaned_fnames
 
+    @property
+    def TAGS_CACHE(self) -> Cache:
+        # Opened lazily, as many uses of a FileGroup never touch the cache
+        if self._tags_cache is None:
+            self.load_tags_cache()
+        return self._tags_cache
+
     def load_tags_cache(self):
         path = Path(self.root) / self.TAGS_CACHE_DIR
         if not path.exists():
             logging.warning(f"Tags cache not found, creating: {path}")
-        self.TAGS_CACHE = Cache(str(path))
+        self._tags_cache = Cache(str(path))
+
+    @property
+    def files_for_modification(self) -> frozenset[str]:
+        return self._files_for_modification[0]
+
+    @property
+    def sorted_files_for_modification(self) -> tuple[str, ...]:
+        """Same as files_for_modification, sorted once when a file is added rather than per use."""
+        return self._files_for_modification[1]
 
     def add_for_modification(self, rel_fname):
-        self.files_for_modification.add(self.abs_root_path(rel_fname))
+        abs_path = self.abs_root_path(rel_fname)
+        with self._modification_lock:
+            files = self._files_for_modification[0]
+            if abs_path not in files:
+                files = files | {abs_path}
+                self._files_for_modification = (files, tuple(sorted(files)))
+        self.invalidate_file_cache()
 
     def get_rel_fname(self, fname):
-        return os.path.relpath(fname, self.root).replace("\\", "/")
+        rel_fname = self._rel_fname_cache.get(fname)
+        if rel_fname is None:
+            rel_fname = os.path.relpath(fname, self._root_norm).replace("\\", "/")
+            self._rel_fname_cache[fname] = rel_fname
+        return rel_fname
 
     def save_tags_cache(self):
         pass
@@ -131,55 +294,172 @@ class FileGroup:
             return []
 
         cache_key = fname + "::" + (key or function.__name__)
-        if cache_key in self.TAGS_CACHE and self.TAGS_CACHE[cache_key]["mtime"] == file_mtime:
-            return self.TAGS_CACHE[cache_key]["data"]
+        entry = self._get_cache_entry(cache_key, file_mtime)
+        if entry is not None:
+            return entry[1]
 
         # miss!
         data = function(fname)
+        self._set_cache_entry(cache_key, file_mtime, data)
+        return data
 
-        # Update the cache
-        self.TAGS_CACHE[cache_key] = {"mtime": file_mtime, "data": data}
+    def _get_cache_entry(self, cache_key: str, file_mtime: float) -> tuple[float, Any] | None:
+        # The in-process cache saves a round trip to the on-disk cache
+        entry = self._mem_cache.get(cache_key)
+        if entry is not None and entry[0] == file_mtime:
+            return entry
+
+        entry = self.TAGS_CACHE.get(cache_key)
+        if entry is not None and entry[0] == file_mtime:
+            self._mem_cache[cache_key] = entry
+            return entry
+        return None
+
+    def _set_cache_entry(self, cache_key: str, file_mtime: float, data: Any):
+        entry = (file_mtime, data)
+        self.TAGS_CACHE[cache_key] = entry
+        self._mem_cache[cache_key] = entry
         self.save_tags_cache()
-        return data
 
-    def get_file_mentions(self, content):
-        words = set(word for word in content.split())
+    def cached_function_call_many(
+        self,
+        fnames: List[str],
+        function: Callable,
+        key: str | None = None,
+        max_workers: int | None = 1,
+    ) -> List[Any]:
+        """
+        Same as cached_function_call for each of the files, with the cache reads
+        and then the cache writes each done in a single transaction of the on-disk cache.
+        The missing results are computed between the two, with no transaction open.
+        :param max_workers: if not 1, the files missing from the cache are processed
+        in a pool of that many processes (None for one per CPU); the function must be picklable then
+        :return: the function's results, in the order of fnames
+        """
+        key = key or function.__name__
+        results = []
+        misses = []
+        with self.batch():
+            for fname in fnames:
+                file_mtime = self.get_mtime(fname)
+                if file_mtime is None:
+                    results.append([])
+                    continue
+
+                cache_key = fname + "::" + key
+                entry = self._get_cache_entry(cache_key, file_mtime)
+                if entry is not None:
+                    results.append(entry[1])
+                else:
+                    misses.append((len(results), fname, cache_key, file_mtime))
+                    results.append(None)
+
+        if not misses:
+            return results
+
+        miss_fnames = [fname for _, fname, _, _ in misses]
+        if max_workers == 1 or len(misses) == 1:
+            computed = list(map(function, miss_fnames))
+        else:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                computed = list(executor.map(function, miss_fnames, chunksize=8))
 
-        # drop sentence punctuation from the end
-        words = set(word.rstrip(",.!;:") for word in words)
+        with self.batch():
+            for (i, _, cache_key, file_mtime), data in zip(misses, computed):
+                self._set_cache_entry(cache_key, file_mtime, data)
+                results[i] = data
+        return results
 
-        # strip away all kinds of quotes
-        quotes = "".join(['"', "'", "`"])
-        words = set(word.strip(quotes) for word in words)
+    @contextmanager
+    def batch(self):
+        """
+        Group the cache reads and writes of many cached_function_call invocations
+        into a single transaction of the on-disk cache.
+        """
+        with self.TAGS_CACHE.transact():
+            yield
 
-        all_files = self.get_all_filenames()
-        other_files = set(all_files) - set(self.files_for_modification)
+    def get_file_mentions(self, content):
+        # drop sentence punctuation from the end, then strip away all kinds of quotes;
+        # dedupe the raw tokens first, as long chats repeat most of them
+        words = {word.rstrip(",.!;:").strip(_QUOTE_CHARS) for word in set(content.split())}
+
+        _, all_files, all_files_set = self._get_all_files_entry(with_tests=False)
+        other_files = all_files_set.difference(self.files_for_modification)
         addable_rel_fnames = [self.get_rel_fname(f) for f in other_files]
 
         mentioned_rel_fnames = set()
-        fname_to_rel_fnames = {}
+        # Mentioned basenames that belong to exactly one file, and those shared by several
+        unique_basenames = {}
+        duplicate_basenames = set()
         for rel_fname in addable_rel_fnames:
             if rel_fname in words:
                 mentioned_rel_fnames.add(str(rel_fname))
 
             fname = os.path.basename(rel_fname)
+            if fname not in words or fname in duplicate_basenames:
+                continue
 
             # Don't add basenames that could be plain words like "run" or "make"
-            if "/" in fname or "." in fname or "_" in fname or "-" in fname:
-                if fname not in fname_to_rel_fnames:
-                    fname_to_rel_fnames[fname] = []
-                fname_to_rel_fnames[fname].append(rel_fname)
+            if any(c in _FNAME_SEP_CHARS for c in fname):
+                if fname in unique_basenames:
+                    del unique_basenames[fname]
+                    duplicate_basenames.add(fname)
+                else:
+                    unique_basenames[fname] = rel_fname
+
+        mentioned_rel_fnames.update(unique_basenames.values())
 
-        for fname, rel_fnames in fname_to_rel_fnames.items():
-            if len(rel_fnames) == 1 and fname in words:
-                mentioned_rel_fnames.add(rel_fnames[0])
+        return self.clean_mentioned_filenames(mentioned_rel_fnames, all_files=all_files)
+
+    def get_basename_index(self, all_files: List[str]) -> Dict[str, List[str]]:
+        """
+        Map the basename of each of the given files to the files that have it,
+        preserving the order of all_files.
+        The index is cached for as long as the same file list is passed in.
+        """
+        if self._basename_index is not None and self._basename_index[0] is all_files:
+            return self._basename_index[1]
 
-        return self.clean_mentioned_filenames(mentioned_rel_fnames)
+        by_basename = defaultdict(list)
+        for name in all_files:
+            by_basename[name.rsplit("/", 1)[-1]].append(name)
 
-    def clean_mentioned_filenames(self, mentioned_filenames: Set[str]) -> Set[str]:
-        all_files = self.get_all_filenames()
+        self._basename_index = (all_files, by_basename)
+        return by_basename
+
+    def get_dir_index(self, all_files: List[str]) -> Dict[str, List[str]]:
+        """
+        Map each directory to the given files directly inside it, preserving the order of all_files.
+        The index is cached for as long as the same file list is passed in.
+        """
+        if self._dir_index is not None and self._dir_index[0] is all_files:
+            return self._dir_index[1]
+
+        dir_to_files = defaultdict(list)
+        for name in all_files:
+            dir_to_files[name.rsplit("/", 1)[0]].append(name)
+
+        self._dir_index = (all_files, dir_to_files)
+        return dir_to_files
+
+    def clean_mentioned_filenames(
+        self, mentioned_filenames: Set[str], all_files: Optional[List[str]] = None
+    ) -> Set[str]:
+        if all_files is None:
+            all_files = self.get_all_filenames()
+        by_basename = self.get_basename_index(all_files)
         clean_mentioned_filenames = []
         for mentioned_name in mentioned_filenames:
+            # Try the files with the same basename for a whole-segment path suffix match first
+            tail = "/" + mentioned_name
+            candidates = by_basename.get(mentioned_name.rsplit("/", 1)[-1], ())
+            match = next((c for c in candidates if c == mentioned_name or c.endswith(tail)), None)
+            if match is not None:
+                clean_mentioned_filenames.append(match)
+                continue
+
+            # Not a path suffix, fall back to a substring scan
             for name in all_files:
                 if mentioned_name in name:
                     clean_mentioned_filenames.append(name)
@@ -192,63 +472,170 @@ class FileGroup:
         level: Optional[int] = 1,
         with_tests: bool = False,
     ) -> List[str] | None:
+        """
+        Get the relative names of the files in the directory, down to the given depth
+        (all the way down if level is None). The files come out sorted, as the file list is.
+        """
         abs_dir = abs_dir.replace("\\", "/").rstrip("/")
         all_abs_files = self.get_all_filenames(with_tests=with_tests)
-        # List all of the above files that are in abs_dir, but not in subdirectories of abs_dir
-        matches = [
-            f
-            for f in all_abs_files
-            if f.startswith(abs_dir) and (not level or f.count("/") == abs_dir.count("/") + level)
-        ]
+
+        if level == 1:
+            matches = self.get_dir_index(all_abs_files).get(abs_dir, [])
+            return [str(self.get_rel_fname(f)) for f in matches]
+
+        # The files are sorted, so the ones under abs_dir form a contiguous range
+        prefix = abs_dir + "/"
+        depth = abs_dir.count("/") + level if level else None
+        matches = []
+        for i in range(bisect.bisect_left(all_abs_files, prefix), len(all_abs_files)):
+            f = all_abs_files[i]
+            if not f.startswith(prefix):
+                break
+            # List the files that are in abs_dir, but not in subdirectories of abs_dir
+            if depth is None or f.count("/") == depth:
+                matches.append(f)
         rel_matches = [str(self.get_rel_fname(f)) for f in matches]
         return rel_matches
 
+    def read_file_content(self, abs_path: str) -> str:
+        """
+        Read a file's text, from memory if it hasn't changed on disk since it was last
+        read or edited through this group.
+        """
+        stamp = self.content_stamp(abs_path)
+        entry = self._content_cache.get(abs_path)
+        if entry is not None and entry[0] == stamp:
+            return entry[1]
+
+        with open(abs_path, "r", encoding="utf-8") as f:
+            content = f.read()
+        self._content_cache[abs_path] = (stamp, content)
+        return content
+
+    @staticmethod
+    def content_stamp(abs_path: str) -> tuple[int, int]:
+        """A cheap stamp of a file's content, that changes whenever the file is written."""
+        st = os.stat(abs_path)
+        return st.st_mtime_ns, st.st_size
+
     def edit_file(self, file_path: str, search: str, replace: str):
         abs_path = self.abs_root_path(file_path)
-        abs_path = Path(abs_path)
 
-        if not abs_path.exists() and not search.strip():
-            abs_path.touch()
-
-        file_content = abs_path.read_text()
+        if not os.path.exists(abs_path) and not search.strip():
+            # Creating a new file, there is nothing to read
+            open(abs_path, "a").close()
+            file_content = ""
+        else:
+            file_content = self.read_file_content(abs_path)
 
         new_content = replace_part(file_content, search, replace)
 
         if new_content and new_content != file_content:
-            abs_path.write_text(new_content)
+            write_text_atomic(abs_path, new_content)
+            # We know what's in the file now, so the next edit doesn't have to read it back
+            self._content_cache[abs_path] = (self.content_stamp(abs_path), new_content)
+            self.invalidate_file_cache()
             return True, None
         else:
             close_match = find_similar_lines(search, file_content)
             return False, close_match
 
 
+def write_text_atomic(path: str, content: str, encoding: str = "utf-8"):
+    """
+    Write the content to a temporary file next to the target, then move it into place,
+    so a crash mid-write never leaves a truncated file behind.
+    Symlinks are written through: the link stays, its target gets the content.
+    """
+    path = os.path.realpath(path)
+    try:
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        mode = None
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".", suffix=".tmp")
+    try:
+        # fd stays ours even if opening it fails (eg an unknown encoding), close it exactly once
+        try:
+            with open(fd, "w", encoding=encoding, closefd=False) as f:
+                f.write(content)
+        finally:
+            os.close(fd)
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.unlink(tmp_path)
+        raise
+
+
 def prepare_content_and_lines(content):
     if content and not content.endswith("\n"):
         content += "\n"
     lines = content.splitlines(keepends=True)
 
-    lines_without_numbers = [re.sub(r"^\d+\s*│", "", line) for line in lines]
+    if "│" not in content:
+        # No line numbers to strip
+        return content, lines
+
+    lines_without_numbers = [_LINE_NUM_RE.sub("", line) for line in lines]
     return "".join(lines_without_numbers), lines_without_numbers
 
 
 def perfect_replace_part(orig_content, search_content, replace_content):
-    if search_content in orig_content:
+    """
+    Replace search_content in orig_content with a plain substring search on the joined text.
+    Both are whole lines ending in newlines, so this is the same as matching a window of lines.
+    Return None if there is no exact match.
+    """
+    idx = orig_content.find(search_content)
+    if idx < 0:
+        return None
+
+    if orig_content.find(search_content, idx + 1) >= 0:
+        # Several occurrences: replace them all
         return orig_content.replace(search_content, replace_content)
 
+    # The common case of a single occurrence: no need to scan the whole content again
+    return orig_content[:idx] + replace_content + orig_content[idx + len(search_content) :]
+
 
 def match_but_for_leading_whitespace(whole_lines, part_lines):
-    num = len(whole_lines)
+    # lengths of the leading whitespace of each line
+    strips = [len(w) - len(w.lstrip()) for w in whole_lines]
+    stripp = [len(p) - len(p.lstrip()) for p in part_lines]
+
+    return _leading_whitespace_to_add(
+        whole_lines,
+        [w[n:] for w, n in zip(whole_lines, strips)],
+        strips,
+        0,
+        [p[n:] for p, n in zip(part_lines, stripp)],
+        stripp,
+    )
+
+
+def _leading_whitespace_to_add(whole_lines, whole_bodies, strips, start, part_bodies, stripp):
+    """
+    Check whether whole_lines[start:start + len(part_bodies)] match the part lines
+    but for a uniform leading whitespace offset, and return that offset.
+    The bodies and strips are the lines without their leading whitespace and its lengths,
+    precomputed by the caller so that they can be reused across start positions.
+    """
+    num = len(part_bodies)
 
     # does the non-whitespace all agree?
-    if not all(whole_lines[i].lstrip() == part_lines[i].lstrip() for i in range(num)):
-        return
+    for i in range(num):
+        if whole_bodies[start + i] != part_bodies[i]:
+            return
 
     # are they all offset the same?
-    add = set(
-        whole_lines[i][: len(whole_lines[i]) - len(part_lines[i])]
+    add = {
+        whole_lines[start + i][: strips[start + i] - stripp[i]]
         for i in range(num)
-        if whole_lines[i].strip()
-    )
+        if strips[start + i] != len(whole_lines[start + i])
+    }
 
     if len(add) != 1:
         return
@@ -273,18 +660,35 @@ def replace_part_with_missing_leading_whitespace(orig_lines, search_lines, repla
 
     # can we find an exact match not including the leading whitespace
     num_search_lines = len(search_lines)
+    if not num_search_lines:
+        return
+    last_start = len(orig_lines) - num_search_lines + 1
+
+    # Strip the leading whitespace of every line once, rather than once per window
+    orig_strips = [len(o) - len(o.lstrip()) for o in orig_lines]
+    orig_bodies = [o[n:] for o, n in zip(orig_lines, orig_strips)]
+    search_strips = [len(p) - len(p.lstrip()) for p in search_lines]
+    search_bodies = [p[n:] for p, n in zip(search_lines, search_strips)]
+    first_body = search_bodies[0]
+
+    for i in range(last_start):
+        if orig_bodies[i] != first_body:
+            continue
 
-    for i in range(len(orig_lines) - num_search_lines + 1):
-        add_leading = match_but_for_leading_whitespace(
-            orig_lines[i : i + num_search_lines], search_lines
+        add_leading = _leading_whitespace_to_add(
+            orig_lines, orig_bodies, orig_strips, i, search_bodies, search_strips
         )
 
         if add_leading is None:
             continue
 
-        replace_lines = [add_leading + rline if rline.strip() else rline for rline in replace_lines]
-        orig_lines = orig_lines[:i] + replace_lines + orig_lines[i + num_search_lines :]
-        return "".join(orig_lines)
+        return "".join(
+            itertools.chain(
+                orig_lines[:i],
+                (add_leading + rline if rline.strip() else rline for rline in replace_lines),
+                orig_lines[i + num_search_lines :],
+            )
+        )
 
 
 def replace_with_dotdotdots(orig, search, replace):
@@ -298,10 +702,12 @@ def replace_with_dotdotdots(orig, search, replace):
     If perfect edit succeeds, return the updated whole.
     """
 
-    dots_re = re.compile(r"(^\s*\.\.\.\n)", re.MULTILINE | re.DOTALL)
+    # Every ... line ends with "...\n", so most edit blocks can skip the regex splits
+    if "...\n" not in search and "...\n" not in replace:
+        return
 
-    search_pieces = re.split(dots_re, search)
-    replace_pieces = re.split(dots_re, replace)
+    search_pieces = _DOTS_RE.split(search)
+    replace_pieces = _DOTS_RE.split(replace)
 
     if len(search_pieces) != len(replace_pieces):
         raise ValueError("Unpaired ... in SEARCH/REPLACE block")
@@ -354,13 +760,24 @@ def replace_part(text, search, replace):
     if not search.strip():
         return text + replace
 
+    # Without line numbers, prepare_content_and_lines would only add a trailing newline,
+    # so try the exact match before paying for splitting everything into lines
+    has_line_numbers = "│" in text or "│" in search or "│" in replace
+    if not has_line_numbers:
+        if text and not text.endswith("\n"):
+            text += "\n"
+        result = perfect_replace_part(text, search, replace)
+        if result:
+            return result
+
     orig_content, orig_lines = prepare_content_and_lines(text)
     search_content, search_lines = prepare_content_and_lines(search)
     replace_content, replace_lines = prepare_content_and_lines(replace)
 
-    result = perfect_replace_part(orig_content, search_content, replace_content)
-    if result:
-        return result
+    if has_line_numbers:
+        result = perfect_replace_part(orig_content, search_content, replace_content)
+        if result:
+            return result
 
     result = replace_part_with_missing_leading_whitespace(orig_lines, search_lines, replace_lines)
     if result:
@@ -376,20 +793,15 @@ def find_similar_lines(search_lines, content_lines, threshold=0.6):
     search_lines = search_lines.splitlines()
     content_lines = content_lines.splitlines()
 
-    best_ratio = 0
-    best_match = None
+    if not search_lines:
+        return ""
 
-    for i in range(len(content_lines) - len(search_lines) + 1):
-        chunk = content_lines[i : i + len(search_lines)]
-        ratio = SequenceMatcher(None, search_lines, chunk).ratio()
-        if ratio > best_ratio:
-            best_ratio = ratio
-            best_match = chunk
-            best_match_i = i
+    best_ratio, best_match_i = best_window(search_lines, content_lines, threshold)
 
     if best_ratio < threshold:
         return ""
 
+    best_match = content_lines[best_match_i : best_match_i + len(search_lines)]
     if best_match[0] == search_lines[0] and best_match[-1] == search_lines[-1]:
         return "\n".join(best_match)
 
@@ -401,27 +813,81 @@ def find_similar_lines(search_lines, content_lines, threshold=0.6):
     return "\n".join(best)
 
 
+def best_window(
+    search_lines: List[str], content_lines: List[str], threshold: float
+) -> tuple[float, int | None]:
+    """
+    Find the window of content_lines most similar to search_lines by difflib's line ratio.
+    Each window is checked against cheap upper bounds of the ratio first, and difflib
+    only scores the windows that could still beat the best one found so far.
+    :return: the best ratio and the window start
+    """
+    k = len(search_lines)
+    best_ratio = 0
+    best_match_i = None
+
+    matcher = SequenceMatcher(None, autojunk=False)
+    matcher.set_seq1(search_lines)
+
+    # The number of lines shared by the window and search_lines (as multisets)
+    # bounds the number of matching lines, so ratio <= overlap / k.
+    # It is updated in O(1) as the window slides
+    search_counts = Counter(search_lines)
+    window_counts = Counter()
+    overlap = 0
+    for line in content_lines[: k - 1]:
+        if window_counts[line] < search_counts[line]:
+            overlap += 1
+        window_counts[line] += 1
+
+    for i in range(len(content_lines) - k + 1):
+        incoming = content_lines[i + k - 1]
+        if window_counts[incoming] < search_counts[incoming]:
+            overlap += 1
+        window_counts[incoming] += 1
+
+        upper_bound = overlap / k
+        if upper_bound >= threshold and upper_bound > best_ratio:
+            window = content_lines[i : i + k]
+            if Indel is not None:
+                # A tighter bound: the longest common subsequence of lines, computed in C.
+                # Indel similarity is twice its length; computed as difflib computes its ratio
+                upper_bound = 2.0 * (Indel.similarity(search_lines, window) // 2) / (2 * k)
+            if upper_bound >= threshold and upper_bound > best_ratio:
+                matcher.set_seq2(window)
+                ratio = matcher.ratio()
+                if ratio > best_ratio:
+                    best_ratio = ratio
+                    best_match_i = i
+
+        outgoing = content_lines[i]
+        window_counts[outgoing] -= 1
+        if window_counts[outgoing] < search_counts[outgoing]:
+            overlap -= 1
+
+    return best_ratio, best_match_i
+
+
 def get_ident_filename_matches(idents, all_rel_fnames: List[str], max_ident_len=2):
-    all_fnames = defaultdict(set)
-    for fname in all_rel_fnames:
-        base = Path(fname).with_suffix("").name.lower()
-        if len(base) >= max_ident_len:
-            all_fnames[base].add(fname)
+    idents = {ident.lower() for ident in idents if len(ident) >= max_ident_len}
 
     matches = set()
-    for ident in idents:
-        if len(ident) < max_ident_len:
-            continue
-        matches.update(all_fnames[ident.lower()])
+    for fname in all_rel_fnames:
+        # The stem of the basename with plain string ops, same as os.path.splitext would give
+        base = fname[fname.rfind("/") + 1 :]
+        dot = base.rfind(".")
+        if dot > 0 and base[:dot].lstrip("."):
+            base = base[:dot]
+        if base.lower() in idents:
+            matches.add(fname)
 
     return matches
 
 
 def get_ident_mentions(text):
-    # Split the string on any character that is not alphanumeric
-    # \W+ matches one or more non-word characters (equivalent to [^a-zA-Z0-9_]+)
-    words = set(re.split(r"\W+", text))
-    return words
+    # Collect the runs of word characters (alphanumerics and underscores);
+    # unlike splitting on \W+, this never yields empty strings
+    return set(_WORD_RE.findall(text))
 
 
 if __name__ == "__main__":
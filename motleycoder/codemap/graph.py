@@ -1,7 +1,9 @@
+import bisect
 import json
 import os
 from collections import defaultdict
-from typing import List, Optional, Dict
+from functools import lru_cache
+from typing import List, Optional, Dict, FrozenSet, Tuple
 
 import networkx as nx
 
@@ -16,14 +18,69 @@ class TagGraph(nx.MultiDiGraph):
     def __init__(self):
         super().__init__()
         self.code_renderer = RenderCode()
+        # Lookup indices, kept up to date by add_node and add_edge
+        self._by_fname: Dict[str, List[Tag]] = defaultdict(list)
+        self._defs_by_name: Dict[str, List[Tag]] = defaultdict(list)
+        self._defs_by_fname: Dict[str, List[Tag]] = defaultdict(list)
+        self._by_fname_and_line: Dict[Tuple[str, int], Tag] = {}
+        self._parents_cache: Dict[Tag, List[Tag] | str] = {}
+        self._fnames_containing_cache: Dict[str, List[str]] = {}
+        self._entity_tags_cache: Dict[tuple, Tuple[List[Tag], List[Tag], bool]] = {}
+
+    def _index_tag(self, tag: Tag):
+        if tag.fname not in self._by_fname:
+            self._fnames_containing_cache.clear()
+        self._by_fname[tag.fname].append(tag)
+        if tag.kind == "def":
+            if self._entity_tags_cache:
+                self._entity_tags_cache.clear()
+            self._defs_by_name[tag.name].append(tag)
+            self._defs_by_fname[tag.fname].append(tag)
+        # The first tag added on a line wins, same as a scan over the nodes would find
+        self._by_fname_and_line.setdefault((tag.fname, tag.line), tag)
+
+    def add_node(self, node_for_adding, **attr):
+        if node_for_adding not in self._node:
+            self._index_tag(node_for_adding)
+        super().add_node(node_for_adding, **attr)
+
+    def add_edge(self, u_for_edge, v_for_edge, key=None, **attr):
+        if self._parents_cache:
+            self._parents_cache.clear()
+        for tag in (u_for_edge, v_for_edge):
+            if tag not in self._node:
+                self._index_tag(tag)
+        return super().add_edge(u_for_edge, v_for_edge, key=key, **attr)
 
     @property
     def filenames(self):
-        return set([tag.fname for tag in self.nodes])
+        return set(self._by_fname)
+
+    @property
+    def defs_by_name(self) -> Dict[str, List[Tag]]:
+        """The def tags by name, in the order they were added to the graph. Don't modify."""
+        return self._defs_by_name
+
+    @property
+    def defs_by_fname(self) -> Dict[str, List[Tag]]:
+        """The def tags by file name, in the order they were added to the graph. Don't modify."""
+        return self._defs_by_fname
+
+    def fnames_containing(self, file_name: str) -> List[str]:
+        """
+        Get the file names in the graph that contain file_name as a substring,
+        eg a basename or a tail of the path. Results are cached until a new file is added.
+        """
+        fnames = self._fnames_containing_cache.get(file_name)
+        if fnames is None:
+            fnames = [f for f in self._by_fname if file_name in f]
+            self._fnames_containing_cache[file_name] = fnames
+        return fnames
 
     def successors_with_attribute(self, node, attr_name, attr_value):
         """
-        Get all neighbors of a node in a MultiDiGraph where the relationship has a specific attribute.
+        Get all neighbors of a node in a MultiDiGraph where the relationship
+        has a specific attribute.
 
         Parameters:
         G (networkx.MultiDiGraph): The graph
@@ -35,13 +92,12 @@ class TagGraph(nx.MultiDiGraph):
         list: A list of neighbors where the relationship has the specified attribute
         """
         neighbors = []
-        for successor in self.successors(node):
-            # Check all edges from node to successor
-            edges = self[node][successor]
-            for key in edges:
-                if edges[key].get(attr_name) == attr_value:
-                    neighbors.append(successor)
-                    break  # Found a valid edge, no need to check further
+        seen = set()
+        # out_edges yields the edges grouped by successor, in the same order as successors()
+        for _, successor, data in self.out_edges(node, data=True):
+            if successor not in seen and data.get(attr_name) == attr_value:
+                seen.add(successor)  # Found a valid edge, no need to check the others
+                neighbors.append(successor)
         return neighbors
 
     def get_parents(self, tag: Tag) -> List[Tag] | str:
@@ -53,18 +109,26 @@ class TagGraph(nx.MultiDiGraph):
         if not len(tag.parent_names):
             return []
 
-        parents = [t for t in self.predecessors(tag) if t.kind == "def"]
-        if not parents:
-            logger.warning(f"No parent found for {tag} with nonempty parent names!")
-            return ".".join(tag.parent_names) + "." + tag.name + ":"
-        parent = parents[0]
-
-        if len(parent.parent_names):
-            predecessors = self.get_parents(parent)
+        cached = self._parents_cache.get(tag)
+        if cached is not None:
+            return list(cached) if isinstance(cached, list) else cached
+
+        # Walk up the chain of parent defs iteratively, innermost first
+        chain = []
+        current = tag
+        while len(current.parent_names):
+            parents = [t for t in self.predecessors(current) if t.kind == "def"]
+            if not parents:
+                logger.warning(f"No parent found for {current} with nonempty parent names!")
+                result = ".".join(tag.parent_names) + "." + tag.name + ":"
+                break
+            current = parents[0]
+            chain.append(current)
         else:
-            predecessors = []
+            result = chain[::-1]
 
-        return predecessors + [parent]
+        self._parents_cache[tag] = result
+        return list(result) if isinstance(result, list) else result
 
     def get_tag_representation(
         self, tag: Tag, parent_details: bool = False, max_lines=200, force_include_full_text=False
@@ -92,7 +156,7 @@ class TagGraph(nx.MultiDiGraph):
         tag_repr.append(RenderCode.text_with_line_numbers(tag))
         tag_repr = "\n".join(tag_repr)
 
-        n_lines = len(tag_repr.split("\n"))
+        n_lines = tag_repr.count("\n") + 1
 
         if force_include_full_text or n_lines <= max_lines:
             # if the full text hast at most 200 lines, put it all in the summary
@@ -104,14 +168,14 @@ class TagGraph(nx.MultiDiGraph):
                     and c.byte_range[1] <= tag.byte_range[1]
                 ) or not data.get("include_in_summary"):
                     continue
-                if c.name in builtins_by_lang.get(c.language, []):
+                if c.name in builtins_by_lang.get(c.language, ()):
                     continue  # skip built-ins
                 children.append(c)
 
             out = [tag_repr]
             if children:
                 chlidren_summary = self.code_renderer.to_tree(children)
-                if n_lines + len(chlidren_summary.split("\n")) < max_lines:
+                if n_lines + chlidren_summary.count("\n") + 1 < max_lines:
                     out.extend(
                         [
                             "Referenced entities summary:",
@@ -121,11 +185,11 @@ class TagGraph(nx.MultiDiGraph):
             return "\n".join(out)
         else:
             # if the full text is too long, send a summary of it and its children
-            children = list(
-                self.successors_with_attribute(tag, attr_name="include_in_summary", attr_value=True)
+            children = self.successors_with_attribute(
+                tag, attr_name="include_in_summary", attr_value=True
             )
             tag_repr = self.code_renderer.to_tree(
-                [tag] + [c for c in children if c.name not in builtins_by_lang.get(c.language, [])]
+                [tag] + [c for c in children if c.name not in builtins_by_lang.get(c.language, ())]
             )
             return tag_repr
 
@@ -154,7 +218,7 @@ class TagGraph(nx.MultiDiGraph):
         :param max_lines: The maximum number of lines to include
         :return: A string representation of the file
         """
-        tags = [t for t in self.nodes if t.fname == file_name]
+        tags = self._by_fname.get(file_name, [])
         if not tags:
             if not file_content:
                 raise ValueError(f"No tags found for file {file_name} and no content provided")
@@ -171,18 +235,19 @@ class TagGraph(nx.MultiDiGraph):
 
             return file_repr
 
-        root_tags = [t for t in tags if not t.parent_names]
-        file_lines = file_content.split("\n")
+        # Display the lines not covered by any root tag: sweep over the root tags sorted by start
+        root_ranges = sorted((t.line, t.end_line) for t in tags if not t.parent_names)
+        n_lines = file_content.count("\n") + 1
         line_nums_to_display = []
 
         i = 0
-        while i < len(file_lines):
-            tag = self.search_line_in_tags(root_tags, i)
-            if tag is not None:
-                i = tag.end_line + 1
-            else:
-                line_nums_to_display.append(i)
-                i += 1
+        for start, end in root_ranges:
+            if i >= n_lines:
+                break
+            if start > i:
+                line_nums_to_display.extend(range(i, min(start, n_lines)))
+            i = max(i, end + 1)
+        line_nums_to_display.extend(range(i, n_lines))
 
         return self.code_renderer.to_tree(
             tags, additional_lines={tags[0].rel_fname: line_nums_to_display}
@@ -191,14 +256,12 @@ class TagGraph(nx.MultiDiGraph):
     def get_tag_from_filename_lineno(
         self, fname: str, line_no: int, try_next_line=True
     ) -> Tag | None:
-        files = [f for f in self.filenames if fname in f]
+        files = self.fnames_containing(fname)
         if not files:
             raise ValueError(f"File {fname} not found in the file group")
-        this_file_nodes = [node for node in self.nodes if node.fname in files]
-        if not this_file_nodes:
-            raise ValueError(f"File {fname} not found in the tag graph")
-        for node in this_file_nodes:
-            if node.line == line_no - 1:
+        for f in files:
+            node = self._by_fname_and_line.get((f, line_no - 1))
+            if node is not None:
                 return node
         # If we got this far, we didn't find the tag
         # Let's look in the next line, sometimes that works
@@ -213,36 +276,75 @@ class TagGraph(nx.MultiDiGraph):
 
         if entity_name is None:
             assert file_name is not None, "Must supply at least one of entity_name, file_name"
-            return [t for t in self.nodes if file_name in t.fname]
+            return [t for f in self.fnames_containing(file_name) for t in self._by_fname[f]]
+
+        re_tags, _, found_in_file = self._find_entity_tags(entity_name, file_name)
+        self._log_entity_lookup(entity_name, file_name, re_tags, found_in_file)
+        return list(re_tags)
+
+    def get_tags_from_entity_name_or_suffix(
+        self, entity_name: str, file_name: Optional[str] = None
+    ) -> Tuple[List[Tag], str]:
+        """
+        Like get_tags_from_entity_name, but if a dotted name like `Foo.bar` matches nothing,
+        falls back to all the definitions of `bar`. Both come out of the same lookup.
+        :return: The matching tags and the name they were matched as
+        """
+        re_tags, candidates, found_in_file = self._find_entity_tags(entity_name, file_name)
+        if re_tags or "." not in entity_name:
+            self._log_entity_lookup(entity_name, file_name, re_tags, found_in_file)
+            return list(re_tags), entity_name
+
+        # Every candidate has the same last name part, which is all a short name is matched by
+        entity_name_short = entity_name.split(".")[-1]
+        self._log_entity_lookup(entity_name_short, file_name, candidates, found_in_file)
+        return list(candidates), entity_name_short
+
+    @staticmethod
+    def _log_entity_lookup(
+        entity_name: str, file_name: Optional[str], re_tags: List[Tag], found_in_file: bool
+    ):
+        if file_name is not None and not found_in_file:
+            logger.warning(
+                f"Definition of entity {entity_name} not found in file {file_name}, searching globally"
+            )
+
+        if len(re_tags) > 1:
+            logger.warning(f"Multiple definitions found for {entity_name}: {re_tags}")
+
+    def _find_entity_tags(
+        self, entity_name: str, file_name: Optional[str]
+    ) -> Tuple[List[Tag], List[Tag], bool]:
+        """
+        The def tags matching the entity name, the candidate tags with the same last name part
+        (in the given file if there are any there), and whether any candidate was in the file.
+        Results are cached until a new def is added, as the agent often repeats its queries.
+        """
+        key = (entity_name, file_name)
+        cached = self._entity_tags_cache.get(key)
+        if cached is not None:
+            return cached
 
         min_entity_name = entity_name.split(".")[-1]
+        orig_tags: List[Tag] = self._defs_by_name.get(min_entity_name, [])
 
         # Composite, like `file.py:method_name`
+        found_in_file = False
         if file_name is not None:
-            preselection: List[Tag] = [t for t in self.nodes if file_name in t.fname]
-
-            test = [t for t in preselection if t.name == min_entity_name and t.kind == "def"]
-            if not test:
-                logger.warning(
-                    f"Definition of entity {entity_name} not found in file {file_name}, searching globally"
-                )
-                preselection: List[Tag] = list(self.nodes)
-        else:
-            preselection: List[Tag] = list(self.nodes)
-
-        orig_tags: List[Tag] = [
-            t for t in preselection if t.name == min_entity_name and t.kind == "def"
-        ]
+            in_file = [t for t in orig_tags if file_name in t.fname]
+            if in_file:
+                orig_tags = in_file
+                found_in_file = True
 
         # do fancier name resolution
         re_tags = [t for t in orig_tags if match_entity_name(entity_name, t)]
 
-        if len(re_tags) > 1:
-            logger.warning(f"Multiple definitions found for {entity_name}: {re_tags}")
-        return re_tags
+        self._entity_tags_cache[key] = (re_tags, orig_tags, found_in_file)
+        return self._entity_tags_cache[key]
 
 
-def load_builtins_by_lang() -> Dict[str, List[str]]:
+@lru_cache(maxsize=1)
+def load_builtins_by_lang() -> Dict[str, FrozenSet[str]]:
     here = os.path.dirname(__file__)
     builtins_by_lang_path = os.path.realpath(os.path.join(here, BUILTINS_BY_LANG_FILE))
     if not os.path.exists(builtins_by_lang_path):
@@ -251,7 +353,12 @@ def load_builtins_by_lang() -> Dict[str, List[str]]:
     with open(builtins_by_lang_path, "r") as file:
         builtins_by_lang = json.load(file)
 
-    return builtins_by_lang
+    return {lang: frozenset(names) for lang, names in builtins_by_lang.items()}
+
+
+def normalize_entity_name(entity_name: str) -> str:
+    """Clean up an entity name as written by the agent, eg `Foo.bar()` -> `Foo.bar`."""
+    return entity_name.strip().replace("()", "")
 
 
 def match_entity_name(entity_name: str, tag: Tag) -> bool:
@@ -298,25 +405,39 @@ def build_tag_graph(tags: List[Tag], code_map: Dict[str, str]) -> TagGraph:
 
     def_map = defaultdict(set)
 
+    refs_by_fname = defaultdict(list)
+
     for tag in tags:
         if tag.kind == "def":
             def_map[tag.name].add(tag)
+        elif tag.kind == "ref":
+            refs_by_fname[tag.fname].append(tag)
         elif tag.kind == "file":
             # Just add all the parsed files to the graph
             G.add_node(tag, kind=tag.kind)
 
+    # Sort each file's refs by start byte, so the refs inside a def can be found by bisection
+    ref_starts_by_fname = {}
+    for fname, refs in refs_by_fname.items():
+        order = sorted(range(len(refs)), key=lambda i: refs[i].byte_range[0])
+        ref_starts_by_fname[fname] = ([refs[i].byte_range[0] for i in order], order)
+
     # Add all tags as nodes
     # Add edges from references to definitions
     for tag in tags:
         G.add_node(tag, kind=tag.kind)
         if tag.kind == "def":
             # Look for any references to other entities inside that definition
-            for ref_tag in tags:
-                if ref_tag.kind == "ref" and ref_tag.fname == tag.fname:
-                    if (
-                        ref_tag.byte_range[0] >= tag.byte_range[0]
-                        and ref_tag.byte_range[1] <= tag.byte_range[1]
-                    ):
+            if tag.fname in ref_starts_by_fname:
+                refs = refs_by_fname[tag.fname]
+                starts, order = ref_starts_by_fname[tag.fname]
+                def_start, def_end = tag.byte_range
+                lo = bisect.bisect_left(starts, def_start)
+                hi = bisect.bisect_right(starts, def_end)
+                # Add the edges in the original order of the refs
+                for i in sorted(order[lo:hi]):
+                    ref_tag = refs[i]
+                    if ref_tag.byte_range[1] <= def_end:
                         G.add_edge(tag, ref_tag)
 
         elif tag.kind == "ref":
@@ -1,11 +1,17 @@
+import ast
+import inspect
 import os
-from typing import List
+import sys
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, List, Set
 
 from grep_ast import filename_to_lang
+from pygments.lexer import Lexer
 from pygments.lexers import guess_lexer_for_filename
 from pygments.token import Token
 from pygments.util import ClassNotFound
-from tree_sitter import Tree, Query, Node
+from tree_sitter import Tree, Query, Node, Parser
 from tree_sitter_languages import get_language
 from tree_sitter_languages import get_parser  # noqa: E402
 
@@ -13,7 +19,20 @@ from motleycrew.common import logger
 from .tag import Tag
 
 
+@lru_cache(maxsize=None)
+def get_cached_parser(lang: str) -> Parser:
+    """
+    Get a tree-sitter parser for a language, constructing it only once per process.
+    """
+    return get_parser(lang)
+
+
+@lru_cache(maxsize=None)
 def get_query(lang: str) -> Query | None:
+    """
+    Load and compile the tags query for a language.
+    The result is cached, as the query files don't change and compiling a query is not free.
+    """
     language = get_language(lang)
     # Load the tags queries
     here = os.path.dirname(__file__)
@@ -29,6 +48,100 @@ def get_query(lang: str) -> Query | None:
     return query
 
 
+class IncrementalParser:
+    """
+    Parse files with tree-sitter, reusing the previous tree of a file if there is one.
+    The changed byte range is found from the common prefix and suffix of the old and new source,
+    the old tree is edited accordingly, and tree-sitter only reparses what's affected.
+    Keeps the trees of the most recently parsed max_files files.
+    """
+
+    def __init__(self, max_files: int = 256):
+        self.max_files = max_files
+        self._trees: OrderedDict[str, tuple[str, bytes, Tree]] = OrderedDict()
+
+    def parse(self, fname: str, lang: str, source: bytes) -> Tree:
+        parser = get_cached_parser(lang)
+        cached = self._trees.pop(fname, None)
+
+        if cached is not None and cached[0] == lang:
+            _, old_source, old_tree = cached
+            if old_source == source:
+                tree = old_tree
+            else:
+                edit_old_tree(old_tree, old_source, source)
+                tree = parser.parse(source, old_tree)
+                if tree.root_node.has_error:
+                    # Error recovery can differ from a fresh parse, so don't trust it
+                    tree = parser.parse(source)
+        else:
+            tree = parser.parse(source)
+
+        self._trees[fname] = (lang, source, tree)
+        while len(self._trees) > self.max_files:
+            self._trees.popitem(last=False)
+        return tree
+
+
+def edit_old_tree(tree: Tree, old_source: bytes, new_source: bytes):
+    """
+    Tell a tree parsed from old_source that the source changed to new_source,
+    as a single edit of the range between their common prefix and common suffix.
+    """
+    start = common_prefix_len(old_source, new_source)
+    max_suffix = min(len(old_source), len(new_source)) - start
+    suffix = common_suffix_len(old_source, new_source, max_suffix)
+    old_end = len(old_source) - suffix
+    new_end = len(new_source) - suffix
+
+    tree.edit(
+        start_byte=start,
+        old_end_byte=old_end,
+        new_end_byte=new_end,
+        start_point=byte_to_point(old_source, start),
+        old_end_point=byte_to_point(old_source, old_end),
+        new_end_point=byte_to_point(new_source, new_end),
+    )
+
+
+def common_prefix_len(a: bytes, b: bytes) -> int:
+    # Bisect on slice comparisons, which run in C, rather than comparing byte by byte
+    n = min(len(a), len(b))
+    if a[:n] == b[:n]:
+        return n
+    lo, hi = 0, n
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+
+def common_suffix_len(a: bytes, b: bytes, max_len: int) -> int:
+    la, lb = len(a), len(b)
+    if a[la - max_len :] == b[lb - max_len :]:
+        return max_len
+    lo, hi = 0, max_len
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if a[la - mid : la - lo] == b[lb - mid : lb - lo]:
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+
+def byte_to_point(source: bytes, offset: int) -> tuple[int, int]:
+    row = source.count(b"\n", 0, offset)
+    column = offset - (source.rfind(b"\n", 0, offset) + 1)
+    return row, column
+
+
+_incremental_parser = IncrementalParser()
+
+
 def ast_to_tags(
     full_file_code: str,
     tree: Tree,
@@ -53,28 +166,57 @@ def ast_to_tags(
         else:
             continue
 
+    # Look nodes up by id rather than by scanning lists of nodes
+    name_positions = {n.id: i for i, n in enumerate(names)}
+    def_ids = {d.id for d, _ in defs}
+
+    # These strings repeat across all the tags of a file (and across files),
+    # so intern them to keep a single copy of each in memory
+    rel_fname = sys.intern(rel_fname.replace("\\", "/"))
+    fname = sys.intern(fname.replace("\\", "/"))
+    language = sys.intern(language) if language is not None else None
+
+    # Decode the node texts straight from the source bytes, without copying them first
+    source = memoryview(full_file_code.encode("utf-8"))
+
+    # Definitions are the parents of many other tags, so only decode each name once
+    def_names: Dict[int, str] = {}
+
+    def def_name(d: Node) -> str:
+        name = def_names.get(d.id)
+        if name is None:
+            name = sys.intern(namenode2name(node2namenode(d, name_positions), source))
+            def_names[d.id] = name
+        return name
+
+    def_parents_cache: Dict[int, tuple] = {}
     out = []
     for node, kind in defs + refs:
-        name_node = node2namenode(node, names)
+        name_node = node2namenode(node, name_positions)
         if name_node is None:
             # logging.warning(f"Could not find name node for {node}")
             # TODO: should we populate these anyway, eg by parsing the text?
             continue
 
-        parent_defs = get_def_parents(node, [d[0] for d in defs])
-        parent_names = tuple([namenode2name(node2namenode(d, names)) for d in parent_defs])
+        parent_defs = get_def_parents(node, def_ids, def_parents_cache)
+        parent_names = tuple([def_name(d) for d in parent_defs])
 
         out.append(
             Tag(
-                rel_fname=rel_fname.replace("\\", "/"),
-                fname=fname.replace("\\", "/"),
-                name=namenode2name(name_node),
+                rel_fname=rel_fname,
+                fname=fname,
+                name=(
+                    def_name(node)
+                    if kind == "def"
+                    else sys.intern(namenode2name(name_node, source))
+                ),
                 parent_names=parent_names,
-                kind=kind,
+                kind=sys.intern(kind),
                 docstring=node2docstring(node, language) if kind == "def" else "",
                 line=name_node.start_point[0],
                 end_line=node.end_point[0],
-                text=node.text.decode("utf-8"),
+                # Nothing reads the source text of references, so don't keep it around
+                text=node_text(node, source) if kind == "def" else "",
                 byte_range=node.byte_range,
                 language=language,
             )
@@ -85,7 +227,10 @@ def ast_to_tags(
 
 def node2docstring(node: Node, language: str) -> str:
     if language == "python":
-        docstring = extract_python_docstring(node.text.decode("utf-8"))
+        if node.has_error or node.child_by_field_name("body") is None:
+            docstring = extract_python_docstring(node.text.decode("utf-8"))
+        else:
+            docstring = python_docstring_from_node(node)
         # TODO: check for more kinds of docstring-like comments
         if docstring is None:
             cmt = [(i, n) for i, n in enumerate(node.children) if n.type == "comment"]
@@ -101,9 +246,36 @@ def node2docstring(node: Node, language: str) -> str:
         return ""
 
 
-def extract_python_docstring(code: str) -> str | None:
-    import ast
+# The node types a docstring statement can consist of
+_PYTHON_DOCSTRING_NODE_TYPES = frozenset(
+    {"string", "concatenated_string", "parenthesized_expression"}
+)
+
 
+def python_docstring_from_node(node: Node) -> str | None:
+    """
+    Get the docstring of a python function or class definition node from its syntax tree,
+    the same way ast.get_docstring would, without compiling the definition's code.
+    """
+    body = node.child_by_field_name("body")
+    statement = next((c for c in body.named_children if c.type != "comment"), None)
+    if statement is None or statement.type != "expression_statement":
+        return None
+
+    expressions = [c for c in statement.named_children if c.type != "comment"]
+    if len(expressions) != 1 or expressions[0].type not in _PYTHON_DOCSTRING_NODE_TYPES:
+        return None
+
+    try:
+        value = ast.literal_eval(expressions[0].text.decode("utf-8"))
+    except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError):
+        # eg f-strings, which are not docstrings
+        return None
+
+    return inspect.cleandoc(value) if isinstance(value, str) else None
+
+
+def extract_python_docstring(code: str) -> str | None:
     # Parse the code into an AST
     try:
         tree = ast.parse(code)
@@ -124,48 +296,102 @@ def extract_python_docstring(code: str) -> str | None:
     return docstring
 
 
-def node2namenode(node: Node, name_nodes: List[Node]) -> Node | None:
-    tmp = [n for n in name_nodes if n in node.children]
+def node2namenode(node: Node, name_positions: Dict[int, int]) -> Node | None:
+    """
+    Find the name node among the children of a node.
+    :param name_positions: maps the ids of the captured name nodes to their position
+        in the captures; if several children are names, the one captured first is returned
+    """
+    tmp = _first_captured(node.children, name_positions)
 
-    if len(tmp) > 0:
-        return tmp[0]
+    if tmp is not None:
+        return tmp
 
     # method calls
-    tmp = [n for n in node.children if n.type == "attribute"]
-    if len(tmp) == 0:
+    tmp = next((n for n in node.children if n.type == "attribute"), None)
+    if tmp is None:
         logger.warning(f"Could not find name node for {node}")
         return None
     # method name
-    tmp = [n for n in name_nodes if n in tmp[0].children]
+    tmp = _first_captured(tmp.children, name_positions)
 
-    if len(tmp) == 0:
+    if tmp is None:
         logger.warning(f"Could not find name node for {node}")
         return None
 
-    return tmp[0]
+    return tmp
+
+
+def _first_captured(nodes: List[Node], name_positions: Dict[int, int]) -> Node | None:
+    found = [(name_positions[n.id], n) for n in nodes if n.id in name_positions]
+    return min(found, key=lambda x: x[0])[1] if found else None
 
 
-def namenode2name(node: Node | None) -> str:
-    return node.text.decode("utf-8") if node else ""
+def namenode2name(node: Node | None, source: memoryview | None = None) -> str:
+    if not node:
+        return ""
+    return node.text.decode("utf-8") if source is None else node_text(node, source)
+
 
+def node_text(node: Node, source: memoryview) -> str:
+    """Decode the text of a node from the source bytes of its tree."""
+    return str(source[node.start_byte : node.end_byte], "utf-8")
 
-def get_def_parents(node: Node, defs: List[Node]) -> List[Node]:
-    dp = []
-    while node.parent is not None:
-        if node.parent in defs:
-            dp.append(node.parent)
-        node = node.parent
-    return tuple(reversed(dp))
+
+def get_def_parents(
+    node: Node, def_ids: Set[int], cache: Dict[int, tuple] | None = None
+) -> List[Node]:
+    """
+    Get the definitions enclosing a node, outermost first.
+    :param cache: maps node ids to the definitions enclosing them, including themselves;
+        share it between the nodes of a tree, so that the walk up stops at the first ancestor
+        seen before instead of going up to the root (every parent access creates a new Node)
+    """
+    if cache is None:
+        cache = {}
+
+    path = []
+    parent = node.parent
+    while parent is not None and parent.id not in cache:
+        path.append(parent)
+        parent = parent.parent
+
+    dp = cache[parent.id] if parent is not None else ()
+    for ancestor in reversed(path):
+        if ancestor.id in def_ids:
+            dp = dp + (ancestor,)
+        cache[ancestor.id] = dp
+    return dp
+
+
+# Guessed pygments lexers by filename, None if there is no lexer for the file
+_lexers_by_fname: Dict[str, Lexer | None] = {}
+
+
+def guess_lexer_cached(fname: str, code: str) -> Lexer | None:
+    """
+    Guess the pygments lexer for a file, only once per filename:
+    guessing tries every lexer whose filename patterns match.
+    """
+    if fname not in _lexers_by_fname:
+        try:
+            _lexers_by_fname[fname] = guess_lexer_for_filename(fname, code)
+        except ClassNotFound:
+            _lexers_by_fname[fname] = None
+    return _lexers_by_fname[fname]
 
 
 def refs_from_lexer(rel_fname, fname, code, language: str | None = None):
-    try:
-        lexer = guess_lexer_for_filename(fname, code)
-    except ClassNotFound:
+    lexer = guess_lexer_cached(fname, code)
+    if lexer is None:
         return []
 
-    tokens = list(lexer.get_tokens(code))
-    tokens = [token[1] for token in tokens if token[0] in Token.Name]
+    # Only the names are needed, so skip the token filters and don't materialize all tokens
+    tokens = [
+        sys.intern(value)
+        for _, token_type, value in lexer.get_tokens_unprocessed(code)
+        if token_type in Token.Name
+    ]
 
     out = [
         Tag(
@@ -190,17 +416,15 @@ def get_tags_raw(fname, rel_fname, code) -> list[Tag]:
     if not lang:
         return []
 
-    parser = get_parser(lang)
-
     if not code:
         return []
 
-    ast = parser.parse(bytes(code, "utf-8"))
+    tree = _incremental_parser.parse(fname, lang, bytes(code, "utf-8"))
     query = get_query(lang)
     if not query:
         return []
 
-    pre_tags = ast_to_tags(code, ast, query, rel_fname, fname, lang)
+    pre_tags = ast_to_tags(code, tree, query, rel_fname, fname, lang)
 
     saw = set([tag.kind for tag in pre_tags])
     if "ref" in saw or "def" not in saw:
@@ -1,71 +1,146 @@
-import copy
 from collections import defaultdict, Counter
 from typing import List, Dict, Collection
 
 import networkx as nx
 import numpy as np
+import scipy as sp
 
+from .graph import TagGraph
 from .map_args import RepoMapArgs
 from .tag import Tag
 
 
 def rank_tags_new(
-    tag_graph: nx.MultiDiGraph,
+    tag_graph: TagGraph,
     args: RepoMapArgs,
     diffusion_mult=0.2,
 ) -> List[Tag | tuple]:
-    G = copy.deepcopy(tag_graph)
-    for tag in G.nodes:
-        G.nodes[tag]["weight"] = 0.0
+    # Keep the weights aside rather than on a copy of the graph
+    weights = dict.fromkeys(tag_graph.nodes, 0.0)
+
+    # Only defs get weights directly: the graph keeps them indexed by name and by file
+    def_tags = [tag for tag in tag_graph.nodes if tag.kind == "def"]
+    def_tags_by_name = tag_graph.defs_by_name
 
     mentioned_entities_clean = set([name.split(".")[-1] for name in args.mentioned_entities])
 
     # process mentioned_idents
-    for tag in tag_graph.nodes:
-        if tag.kind == "def":
+    for name in mentioned_entities_clean.union(args.mentioned_idents):
+        for tag in def_tags_by_name.get(name, ()):
             if tag.fname in args.chat_fnames and tag.name in mentioned_entities_clean:
-                G.nodes[tag]["weight"] += 3.0
+                weights[tag] += 3.0
 
             elif tag.name in args.mentioned_idents:
-                G.nodes[tag]["weight"] += 1.0
+                weights[tag] += 1.0
 
     # process mentioned_fnames
     mentioned_weights = weights_from_fnames(tag_graph, args.mentioned_fnames)
     for tag, weight in mentioned_weights.items():
-        G.nodes[tag]["weight"] += 0.2 * weight
+        weights[tag] += 0.2 * weight
 
     # process chat_fnames
     chat_fname_weights = weights_from_fnames(tag_graph, args.chat_fnames)
     for tag, weight in chat_fname_weights.items():
-        G.nodes[tag]["weight"] += 0.5 * weight
+        weights[tag] += 0.5 * weight
 
     # process search_terms:
-    tag_matches = defaultdict(set)
-    for tag in tag_graph.nodes:
-        for term in args.search_terms:
-            if tag.kind == "def" and term in tag.text:
-                tag_matches[term].add(tag)
+    # collect the matches term by term, then order the terms as a tag-major scan would have
+    # first seen them, so that the weights are summed in the same order
+    # a def's text is a part of its file's code, so files whose code doesn't contain a term
+    # can be skipped with a single scan, instead of scanning each of their defs
+    code_map = tag_graph.code_renderer.code_map
+    def_indices_by_fname = defaultdict(list)
+    if args.search_terms:
+        for i, tag in enumerate(def_tags):
+            def_indices_by_fname[tag.fname].append(i)
+
+    term_matches = {}
+    for term_pos, term in enumerate(args.search_terms):
+        matches = []
+        for fname, indices in def_indices_by_fname.items():
+            code = code_map.get(fname)
+            if code is not None and term not in code:
+                continue
+            matches += [i for i in indices if term in def_tags[i].text]
+        matches.sort()
+        if matches:
+            term_matches[term] = (matches[0], term_pos, matches)
+    tag_matches = {
+        term: {def_tags[i] for i in matches}
+        for term, (_, _, matches) in sorted(term_matches.items(), key=lambda x: x[1][:2])
+    }
 
     typical_search_count = np.median([len(tags) for tags in tag_matches.values()])
     for term, tags in tag_matches.items():
         for tag in tags:
-            G.nodes[tag]["weight"] += typical_search_count / len(tags)
-
-    # diffuse these weights through the graph
-    G1 = copy.deepcopy(G)
-    for t in G.nodes:
-        for _, t2 in G.out_edges(t):
-            G.nodes[t2]["weight"] += G1.nodes[t]["weight"] * diffusion_mult
-
-    # Order the tags by weight
-    node_list = [(G.nodes[tag]["weight"], tag) for tag in G.nodes]
-    tags = sorted(
-        node_list,
-        key=lambda x: x[0],
-        reverse=True,
-    )
+            weights[tag] += typical_search_count / len(tags)
+
+    # diffuse these weights through the graph: each edge adds a share of its source's weight
+    # to its target, all at once from the pre-diffusion weights
+    nodes = list(weights)
+    index = {tag: i for i, tag in enumerate(nodes)}
+    weight_vector = np.fromiter(weights.values(), dtype=float, count=len(nodes))
+    n_edges = tag_graph.number_of_edges()
+    sources = np.fromiter((index[u] for u, _ in tag_graph.edges()), dtype=np.intp, count=n_edges)
+    targets = np.fromiter((index[v] for _, v in tag_graph.edges()), dtype=np.intp, count=n_edges)
+
+    diffused = weight_vector.copy()
+    # add.at accumulates in edge order, like a loop over the edges would
+    np.add.at(diffused, targets, weight_vector[sources] * diffusion_mult)
+
+    # Order the tags by weight, keeping the graph order for ties
+    order = np.argsort(-diffused, kind="stable")
+    # tolist converts the indices to Python ints in one go, which makes the lookups cheaper
+    return [nodes[i] for i in order.tolist()]
+
+
+def pagerank(
+    nodes: List[str],
+    out_weights: Dict[str, Dict[str, float]],
+    personalization: Dict[str, float] | None = None,
+    alpha: float = 0.85,
+    max_iter: int = 100,
+    tol: float = 1.0e-6,
+) -> Dict[str, float]:
+    """
+    PageRank by power iteration on a sparse matrix, same as nx.pagerank
+    with the personalization also used for the dangling nodes,
+    but without building a networkx graph and converting it to a matrix first.
+    """
+    n = len(nodes)
+    if n == 0:
+        return {}
+
+    index = {node: i for i, node in enumerate(nodes)}
+    rows, cols, data = [], [], []
+    for src, dst_weights in out_weights.items():
+        for dst, weight in dst_weights.items():
+            rows.append(index[src])
+            cols.append(index[dst])
+            data.append(weight)
+    A = sp.sparse.csr_array((np.array(data, dtype=float), (rows, cols)), shape=(n, n))
+
+    # Normalize the rows to make the transition matrix
+    S = A.sum(axis=1)
+    S[S != 0] = 1.0 / S[S != 0]
+    A = sp.sparse.dia_array((S.T, 0), shape=A.shape).tocsr() @ A
+
+    x = np.repeat(1.0 / n, n)
+    if personalization is None:
+        p = np.repeat(1.0 / n, n)
+    else:
+        p = np.array([personalization.get(node, 0) for node in nodes], dtype=float)
+        if p.sum() == 0:
+            raise ZeroDivisionError
+        p /= p.sum()
+    is_dangling = np.where(S == 0)[0]
 
-    return [t[1] for t in tags]
+    for _ in range(max_iter):
+        xlast = x
+        x = alpha * (x @ A + sum(x[is_dangling]) * p) + (1 - alpha) * p
+        if np.absolute(x - xlast).sum() < n * tol:
+            return dict(zip(nodes, map(float, x)))
+    raise nx.PowerIterationFailedConvergence(max_iter)
 
 
 def rank_tags(
@@ -111,7 +186,12 @@ def rank_tags(
 
     idents = set(defines.keys()).intersection(set(references.keys()))
 
-    G = nx.MultiDiGraph()
+    # PageRank only needs the total weight between two files, so collapse the edges for
+    # different idents into a single weighted edge; keep the per-ident edges aside, grouped
+    # by source and target in insertion order, to distribute the rank over them afterwards
+    nodes = {}
+    out_weights = defaultdict(dict)
+    ident_edges = defaultdict(lambda: defaultdict(list))
 
     for ident in idents:
         definers = defines[ident]
@@ -123,28 +203,27 @@ def rank_tags(
             for definer in definers:
                 # if referencer == definer:
                 #    continue
-                G.add_edge(referencer, definer, weight=mul * num_refs, ident=ident)
-
-    if personalization:
-        pers_args = dict(personalization=personalization, dangling=personalization)
-    else:
-        pers_args = dict()
+                weight = mul * num_refs
+                nodes.setdefault(referencer)
+                nodes.setdefault(definer)
+                dst_weights = out_weights[referencer]
+                dst_weights[definer] = dst_weights.get(definer, 0) + weight
+                ident_edges[referencer][definer].append((weight, ident))
 
     try:
-        ranked = nx.pagerank(G, weight="weight", **pers_args)
+        ranked = pagerank(list(nodes), out_weights, personalization or None)
     except ZeroDivisionError:
         return []
 
     # distribute the rank from each source node, across all of its out edges
     ranked_definitions = defaultdict(float)
-    for src in G.nodes:
+    for src in nodes:
         src_rank = ranked[src]
-        total_weight = sum(data["weight"] for _src, _dst, data in G.out_edges(src, data=True))
+        total_weight = sum(out_weights[src].values())
         # dump(src, src_rank, total_weight)
-        for _src, dst, data in G.out_edges(src, data=True):
-            data["rank"] = src_rank * data["weight"] / total_weight
-            ident = data["ident"]
-            ranked_definitions[(dst, ident)] += data["rank"]
+        for dst, edges in ident_edges[src].items():
+            for weight, ident in edges:
+                ranked_definitions[(dst, ident)] += src_rank * weight / total_weight
 
     ranked_tags = []
     ranked_definitions = sorted(ranked_definitions.items(), reverse=True, key=lambda x: x[1])
@@ -180,18 +259,22 @@ def rank_tags(
 
 
 def weights_from_fnames(
-    tag_graph: nx.MultiDiGraph, mentioned_fnames: Collection[str]
+    tag_graph: TagGraph,
+    mentioned_fnames: Collection[str],
 ) -> Dict[Tag, float]:
+    # Only look at the defs of the mentioned files, not at the whole graph
+    def_tags_by_fname = tag_graph.defs_by_fname
     tag_weights = defaultdict(float)
-    fname_counts = defaultdict(int)
-    for tag in tag_graph.nodes:
-        if tag.kind == "def" and tag.fname in mentioned_fnames:
-            fname_counts[tag.fname] += 1
+    fname_counts = {
+        fname: len(def_tags_by_fname[fname])
+        for fname in mentioned_fnames
+        if def_tags_by_fname.get(fname)
+    }
 
     # Normalize the weights to take into account what's typical in the codebase
     typical_count = np.median(np.array(list(fname_counts.values())))
-    for tag in tag_graph.nodes:
-        if tag.fname in fname_counts and tag.kind == "def":
-            tag_weights[tag] += typical_count / fname_counts[tag.fname]
+    for fname, count in fname_counts.items():
+        for tag in def_tags_by_fname[fname]:
+            tag_weights[tag] += typical_count / count
 
     return tag_weights
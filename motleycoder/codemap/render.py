@@ -1,3 +1,5 @@
+import itertools
+from functools import lru_cache
 from typing import List, Optional, Dict
 
 from grep_ast import TreeContext
@@ -5,6 +7,14 @@ from grep_ast import TreeContext
 from .tag import Tag
 
 
+def tag_sort_key(tag: Tag | tuple) -> tuple:
+    """
+    The key to sort tags and bare (rel_fname,) tuples together, same as tuple(tag)
+    but without calling Tag.__getitem__ (and rebuilding the tuple) for each of the fields.
+    """
+    return tag.to_tuple() if isinstance(tag, Tag) else tag
+
+
 class RenderCode:
     def __init__(self):
         self.tree_cache = {}
@@ -15,7 +25,12 @@ class RenderCode:
         tags: List[Tag | tuple],
         render_file_name: bool = True,
         additional_lines: Optional[Dict[str, List[int]]] = None,
+        presorted: bool = False,
     ) -> str:
+        """
+        Render the tags as a tree, grouped by file.
+        Pass presorted=True if the tags are already sorted by tag_sort_key, to skip the sorting.
+        """
         if not tags:
             return ""
 
@@ -25,33 +40,36 @@ class RenderCode:
             render_file_name or len(set(tag.fname for tag in tags)) <= 1
         ), "can't render without filenames if there are multiple files"
 
-        tags = sorted(tags, key=lambda x: tuple(x))
+        if not presorted:
+            tags = sorted(tags, key=tag_sort_key)
 
         cur_fname = None
         cur_abs_fname = None
         lois = None
-        output = ""
+        parts = []
 
         # add a bogus tag at the end so we trip the this_fname != cur_fname...
         dummy_tag = (None,)
-        for tag in tags + [dummy_tag]:
+        for tag in itertools.chain(tags, [dummy_tag]):
             this_rel_fname = tag[0]
 
             # ... here ... to output the final real entry in the list
             if this_rel_fname != cur_fname:
                 if lois is not None:
-                    output += "\n"
+                    parts.append("\n")
                     if render_file_name:
-                        output += cur_fname + ":\n"
-                    output += self.render_tree(
-                        cur_fname,
-                        lois + additional_lines.get(cur_fname, []),
-                        code=self.code_map[cur_abs_fname],
+                        parts.append(cur_fname + ":\n")
+                    parts.append(
+                        self.render_tree(
+                            cur_fname,
+                            lois + additional_lines.get(cur_fname, []),
+                            code=self.code_map[cur_abs_fname],
+                        )
                     )
                     lois = None
                 elif cur_fname:
                     if render_file_name:
-                        output += "\n" + cur_fname + "\n"
+                        parts.append("\n" + cur_fname + "\n")
                 if type(tag) is Tag:
                     lois = []
                     cur_abs_fname = tag.fname
@@ -61,7 +79,7 @@ class RenderCode:
                 lois.append(tag.line)
 
         # truncate long lines, in case we get minified js or something else crazy
-        output = "\n".join([line[:100] for line in output.splitlines()]) + "\n"
+        output = "\n".join([line[:100] for line in "".join(parts).splitlines()]) + "\n"
 
         return output
 
@@ -96,12 +114,17 @@ class RenderCode:
 
     @staticmethod
     def text_with_line_numbers(t: Tag) -> str:
-        out = []
-        for i, line in enumerate(t.text.split("\n")):
-            re_line = RenderCode.render_line(line, i + 1 + t.line)
-            out.append(re_line)
-        return "\n".join(out)
+        # The same entities get rendered over and over while the agent explores the code
+        return _text_with_line_numbers(t.text, t.line)
 
     @staticmethod
     def render_line(line: str, number: int) -> str:
         return f"{number:3}│{line}"
+
+
+@lru_cache(maxsize=256)
+def _text_with_line_numbers(text: str, line: int) -> str:
+    return "\n".join(
+        RenderCode.render_line(text_line, i + 1 + line)
+        for i, text_line in enumerate(text.split("\n"))
+    )
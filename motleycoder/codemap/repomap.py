@@ -1,7 +1,9 @@
 import json
 import os
 import warnings
-from typing import List, Set, Optional
+from collections import OrderedDict, defaultdict
+from functools import partial
+from typing import Callable, Dict, List, Set, Optional
 
 import litellm
 from langchain_core.pydantic_v1 import BaseModel, Field
@@ -16,13 +18,27 @@ from .graph import TagGraph, build_tag_graph, only_defs  # noqa: F402
 from .map_args import RepoMapArgs
 from .parse import get_tags_raw, read_text  # noqa: F402
 from .rank import rank_tags_new, rank_tags  # noqa: F402
-from .render import RenderCode
+from .render import RenderCode, tag_sort_key
 
 # tree_sitter is throwing a FutureWarning
 warnings.simplefilter("ignore", category=FutureWarning)
 
 
+def get_tags_raw_function(fname: str, root: str) -> tuple[str | None, list]:
+    code = read_text(fname)
+    rel_fname = os.path.relpath(fname, root).replace("\\", "/")
+    data = get_tags_raw(fname, rel_fname, code)
+    assert isinstance(data, list)
+    return code, data
+
+
 class RepoMap:
+    # How many of the most recently used tag graphs to keep for reuse:
+    # enough for the graphs with and without the tests
+    MAX_RECENT_GRAPHS = 2
+    # How many rendered tool outputs to keep
+    MAX_TOOL_OUTPUTS = 256
+
     def __init__(
         self,
         map_tokens: int = 1024,
@@ -33,6 +49,7 @@ class RepoMap:
         file_group: FileGroup = None,
         use_old_ranking: bool = False,
         cache_graphs: bool = False,
+        parse_workers: int | None = 1,
     ):
         self.verbose = verbose
         self.use_old_ranking = use_old_ranking
@@ -48,6 +65,17 @@ class RepoMap:
         self.file_group = file_group
         self.code_renderer = RenderCode()
         self.tag_graphs = {} if cache_graphs else None
+        # The keys of the cached tag graphs that include each file
+        self._graph_keys_by_fname: Dict[str, Set[tuple]] = defaultdict(set)
+        # Number of processes to parse uncached files with: 1 parses in this process,
+        # None uses one per CPU (scripts then need an `if __name__ == "__main__"` guard)
+        self.parse_workers = parse_workers
+        # The last few graphs built, with the content stamps of their files,
+        # so that repeated tool calls on an unchanged repo don't rebuild them
+        self._recent_graphs: Dict[tuple, tuple[tuple, TagGraph]] = {}
+        # Rendered tool outputs, valid for as long as the tag graph they were rendered from
+        self._tool_outputs_graph: TagGraph | None = None
+        self._tool_outputs: OrderedDict[tuple, str] = OrderedDict()
 
     def tokenizer(self, text):
         return litellm.encode(model=self.llm_name, text=text)
@@ -98,20 +126,34 @@ class RepoMap:
     def get_tag_graph(
         self, abs_fnames: List[str] | None = None, with_tests: bool = False
     ) -> TagGraph:
+        """
+        Get the tag graph of the files, all the files in the group by default.
+        Graphs are built on demand; the graphs with and without the tests are both kept
+        among the recent ones, so tools asking for either don't make each other rebuild.
+        The graph without the tests is built on its own rather than filtered out of the full one,
+        as the test files' definitions affect the edges and the ranking.
+        """
         if not abs_fnames:
             abs_fnames = self.file_group.get_all_filenames(with_tests=with_tests)
         clean_fnames = self.file_group.validate_fnames(abs_fnames, with_tests=with_tests)
+        key = tuple(clean_fnames)
+
+        stamps = self._content_stamps(clean_fnames)
+        recent = self._recent_graphs.get(key)
+        if recent is not None and recent[0] == stamps:
+            return recent[1]
 
         if self.tag_graphs is not None:
+            clean_fnames_set = set(clean_fnames)
             for files, graph in self.tag_graphs.items():
-                if not set(clean_fnames).difference(set(files)):
+                if clean_fnames_set.issubset(files):
+                    self._remember_graph(key, stamps, graph)
                     return graph
 
         # If no caching or cached graph not found, construct it
         all_tags = []
         code_map = {}
-        for fname in clean_fnames:
-            code, tags = self.tags_from_filename(fname)
+        for fname, (code, tags) in zip(clean_fnames, self.tags_from_filenames(clean_fnames)):
             all_tags += tags
             code_map[fname] = code
 
@@ -119,18 +161,79 @@ class RepoMap:
         graph = only_defs(raw_graph)
 
         if self.tag_graphs is not None:
-            self.tag_graphs[tuple(clean_fnames)] = graph
+            self.tag_graphs[key] = graph
+            for fname in key:
+                self._graph_keys_by_fname[fname].add(key)
+        self._remember_graph(key, stamps, graph)
         return graph
 
-    def tags_from_filename(self, fname):
-        def get_tags_raw_function(fname):
-            code = read_text(fname)
-            rel_fname = self.file_group.get_rel_fname(fname)
-            data = get_tags_raw(fname, rel_fname, code)
-            assert isinstance(data, list)
-            return code, data
+    def _content_stamps(self, fnames: List[str]) -> tuple | None:
+        try:
+            return tuple(self.file_group.content_stamp(fname) for fname in fnames)
+        except OSError:
+            return None
 
-        return self.file_group.cached_function_call(fname, get_tags_raw_function)
+    def _remember_graph(self, key: tuple, stamps: tuple | None, graph: TagGraph):
+        if stamps is None:
+            return
+        self._recent_graphs.pop(key, None)
+        self._recent_graphs[key] = (stamps, graph)
+        while len(self._recent_graphs) > self.MAX_RECENT_GRAPHS:
+            del self._recent_graphs[next(iter(self._recent_graphs))]
+
+    def get_cached_tool_output(
+        self, tag_graph: TagGraph, key: tuple, compute: Callable[[], str]
+    ) -> str:
+        """
+        Get a tool output rendered from the tag graph, computing it if it's not cached.
+        The cache is shared by all the tools using this repo map, and is dropped
+        as soon as a different tag graph is used, eg because some files have changed.
+        """
+        if tag_graph is not self._tool_outputs_graph:
+            self._tool_outputs_graph = tag_graph
+            self._tool_outputs.clear()
+
+        output = self._tool_outputs.get(key)
+        if output is not None:
+            self._tool_outputs.move_to_end(key)
+            return output
+
+        output = compute()
+        self._tool_outputs[key] = output
+        if len(self._tool_outputs) > self.MAX_TOOL_OUTPUTS:
+            self._tool_outputs.popitem(last=False)
+        return output
+
+    def invalidate_tag_graphs(self, fname: str):
+        """Drop the cached tag graphs that include the file, eg after it was edited."""
+        for key in [key for key in self._recent_graphs if fname in key]:
+            del self._recent_graphs[key]
+        self._tool_outputs.clear()
+
+        if self.tag_graphs is None:
+            return
+
+        for key in self._graph_keys_by_fname.pop(fname, ()):
+            self.tag_graphs.pop(key, None)
+            for other_fname in key:
+                other_keys = self._graph_keys_by_fname.get(other_fname)
+                if other_keys is not None:
+                    other_keys.discard(key)
+                    if not other_keys:
+                        del self._graph_keys_by_fname[other_fname]
+
+    def tags_from_filename(self, fname):
+        return self.tags_from_filenames([fname])[0]
+
+    def tags_from_filenames(self, fnames: List[str]) -> List[tuple]:
+        # The files missing from the cache are parsed in worker processes,
+        # so the parsing function must be picklable
+        return self.file_group.cached_function_call_many(
+            fnames,
+            partial(get_tags_raw_function, root=self.file_group.root),
+            key="get_tags_raw_function",
+            max_workers=self.parse_workers,
+        )
 
     def get_ranked_tags(
         self,
@@ -174,9 +277,14 @@ class RepoMap:
         # Guess a small starting number to help with giant repos
         middle = min(self.max_map_tokens // 25, num_tags)
 
+        # to_tree renders the tags sorted: sort all of them once, then each candidate
+        # is just the sorted tags that rank above the cutoff (the sort is stable, so ties
+        # stay in rank order, same as sorting each candidate)
+        sorted_order = sorted(range(num_tags), key=lambda i: tag_sort_key(ranked_tags[i]))
+
         while lower_bound <= upper_bound:
-            used_tags = [tag for tag in ranked_tags[:middle]]
-            tree = self.code_renderer.to_tree(used_tags)
+            used_tags = [ranked_tags[i] for i in sorted_order if i < middle]
+            tree = self.code_renderer.to_tree(used_tags, presorted=True)
             num_tokens = self.token_count(tree)
 
             if self.max_map_tokens > num_tokens > best_tree_tokens:
@@ -201,7 +309,7 @@ class RepoMap:
     ) -> str:
         all_files = self.file_group.get_all_filenames()
         added_files = self.file_group.files_for_modification
-        other_files = set(all_files) - set(added_files)
+        other_files = self.file_group.get_all_filenames_set() - added_files
 
         if llm is not None:
             search_terms = search_terms_from_message(message, llm)
@@ -229,7 +337,7 @@ class RepoMap:
         # fall back to global repo map if files in chat are disjoint from rest of repo
         if not repo_content:
             args.chat_fnames = set()
-            args.other_fnames = set(all_files)
+            args.other_fnames = set(self.file_group.get_all_filenames_set())
 
             repo_content = self.get_repo_map(args)
 
@@ -264,6 +372,4 @@ def search_terms_from_message(message: str, llm) -> Set[str]:
         )
 
     out = llm.with_structured_output(ListOfStrings).invoke(search_prompt)
-    re_out = [x.split(".")[-1] for x in out.strings]
-    re_out = sum([x.split(",") for x in re_out], [])
-    return set(re_out)
+    return {term for x in out.strings for term in x.split(".")[-1].split(",")}
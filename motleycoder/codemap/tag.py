@@ -1,7 +1,8 @@
-from dataclasses import dataclass
+import sys
+from dataclasses import dataclass, field, fields
 
 
-@dataclass
+@dataclass(slots=True)
 class Tag:
     rel_fname: str
     line: int
@@ -15,6 +16,7 @@ class Tag:
     parent_names: tuple[str, ...] = ()
     language: str | None = None
     n_defs: int = 0
+    _hash: int | None = field(default=None, init=False, repr=False, compare=False)
 
     @property
     def full_name(self):
@@ -43,4 +45,21 @@ class Tag:
         return len(self.to_tuple())
 
     def __hash__(self):
-        return hash(self.to_tuple())
+        # Tags are hashed all the time as dict keys and graph nodes,
+        # so only hash the identifying fields, and only once
+        if self._hash is None:
+            self._hash = hash(
+                (self.rel_fname, self.line, self.name, self.kind, self.byte_range)
+            )
+        return self._hash
+
+    def __getstate__(self):
+        # Don't pickle the cached hash: string hashes differ between processes
+        return [None if f.name == "_hash" else getattr(self, f.name) for f in fields(self)]
+
+    def __setstate__(self, state):
+        for f, value in zip(fields(self), state):
+            setattr(self, f.name, value)
+        # Pickling keeps a single copy of each string within a file's tags, but names repeat
+        # across files too: share them between files, like freshly parsed tags do
+        self.name = sys.intern(self.name)
@@ -1,9 +1,12 @@
+import hashlib
 import os
 import re
 import subprocess
 import sys
+import threading
 import traceback
 import warnings
+from collections import OrderedDict
 from dataclasses import dataclass
 from pathlib import Path
 
@@ -24,7 +27,15 @@ class Linter:
         )
         self.all_lint_cmd = None
 
+        # Lint results by (file name, command, content hash): re-linting unchanged content
+        # gives the same result, without spawning the linters again
+        self._cache: OrderedDict[tuple, str | None] = OrderedDict()
+        self.max_cache_size = 256
+        # Files may be linted from several threads, see FileEditTool.edit_files
+        self._cache_lock = threading.Lock()
+
     def set_linter(self, lang, cmd):
+        self._cache.clear()
         if lang:
             self.languages[lang] = cmd
             return
@@ -68,9 +79,25 @@ class Linter:
         return LintResult(text=errors, lines=linenums)
 
     def lint(self, fname, cmd=None):
-        rel_fname = self.get_rel_fname(fname)
         code = Path(fname).read_text(self.encoding)
 
+        key = (fname, cmd, hashlib.blake2b(code.encode(self.encoding), digest_size=16).digest())
+        with self._cache_lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        res = self._lint(fname, code, cmd)
+
+        with self._cache_lock:
+            self._cache[key] = res
+            if len(self._cache) > self.max_cache_size:
+                self._cache.popitem(last=False)
+        return res
+
+    def _lint(self, fname, code, cmd=None):
+        rel_fname = self.get_rel_fname(fname)
+
         if cmd:
             cmd = cmd.strip()
         if not cmd:
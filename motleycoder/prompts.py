@@ -1,6 +1,7 @@
 import json
+from functools import lru_cache
 
-from langchain_core.messages import HumanMessage, AIMessage, ToolMessage
+from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, ToolMessage
 from langchain_core.prompts import SystemMessagePromptTemplate, ChatPromptTemplate
 
 
@@ -49,7 +50,8 @@ All changes to files must be made using the `edit_file` tool.
 """
     )
 
-    example_messages = [
+    # Immutable: shared by all the instances and templates
+    example_messages: tuple[BaseMessage, ...] = (
         HumanMessage(
             content="Change get_factorial() to use math.factorial",
         ),
@@ -272,7 +274,7 @@ I can now apply the changes to the code base.
             content="Changes applied successfully.",
             tool_call_id="call_7TmRhiBSX5ud8DW1RyZSEcDf",
         ),
-    ]
+    )
 
     system_reminder = SystemMessagePromptTemplate.from_template(
         """# `edit_file` tool call Rules:
@@ -306,10 +308,28 @@ All changes to files must be made using the `edit_file` tool.
 """
     )
 
-    def __init__(self):
-        messages = [self.main_system]
+    # Provider-side prompt caching marker, for the providers that need one (e.g. Anthropic)
+    cache_control = {"type": "ephemeral"}
+
+    # The only template variable allowed in the static part, it doesn't change between the turns
+    static_input_variables = frozenset({"tools"})
+
+    def __init__(self, cache_static_prefix: bool = False):
+        """
+        :param cache_static_prefix: mark the end of the prompt as a cache breakpoint,
+            so that providers with explicit prompt caching can reuse it across the turns.
 
-        messages += self.example_messages
+        Ordering contract: ``prompt_template`` is the static prefix (tools aside).
+        The dynamic content (repo map, file summaries, the task itself) must never be
+        formatted into it, it goes after it, in the task prompt given to the agent.
+        """
+        # The messages are all static, so the template is built once and shared
+        self.prompt_template = type(self).build_prompt_template(cache_static_prefix)
+
+    @classmethod
+    @lru_cache(maxsize=None)
+    def build_prompt_template(cls, cache_static_prefix: bool = False) -> ChatPromptTemplate:
+        messages = [cls.main_system, *cls.example_messages]
         messages += [
             HumanMessage(
                 "I switched to a new code base. Please don't consider the above files"
@@ -318,6 +338,20 @@ All changes to files must be made using the `edit_file` tool.
             AIMessage("Ok."),
         ]
 
-        messages += [self.system_reminder]
-
-        self.prompt_template = ChatPromptTemplate.from_messages(messages)
+        if cache_static_prefix:
+            system_reminder = cls.system_reminder.copy(
+                update={"additional_kwargs": {"cache_control": cls.cache_control}}
+            )
+        else:
+            system_reminder = cls.system_reminder
+        messages += [system_reminder]
+
+        template = ChatPromptTemplate.from_messages(messages)
+        dynamic_variables = set(template.input_variables) - cls.static_input_variables
+        if dynamic_variables:
+            raise ValueError(
+                f"Dynamic content must not be part of the static prompt prefix, "
+                f"pass it in the task prompt instead: {sorted(dynamic_variables)}"
+            )
+
+        return template
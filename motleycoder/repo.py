@@ -1,3 +1,5 @@
+import os
+from functools import lru_cache
 from pathlib import Path, PurePosixPath
 
 import git
@@ -7,6 +9,7 @@ class GitRepo:
     def __init__(self, repo_path):
         self.repo = git.Repo(repo_path, search_parent_directories=True, odbt=git.GitDB)
         self.root = Path(self.repo.working_dir).resolve()
+        self._tracked_cache: tuple[tuple, frozenset[str]] | None = None
 
     def diff_commits(self, pretty, from_commit, to_commit):
         args = []
@@ -19,9 +22,17 @@ class GitRepo:
         return diffs
 
     def get_tracked_files(self):
+        """
+        Get the files in HEAD plus the staged ones.
+        The result is cached until HEAD moves or the index is written.
+        """
         if not self.repo:
             return []
 
+        signature = self.get_tracked_files_signature()
+        if self._tracked_cache is not None and self._tracked_cache[0] == signature:
+            return self._tracked_cache[1]
+
         try:
             commit = self.repo.head.commit
         except ValueError:
@@ -40,38 +51,63 @@ class GitRepo:
         files.extend(staged_files)
 
         # convert to appropriate os.sep, since git always normalizes to /
-        res = set(self.normalize_path(path) for path in files)
+        res = frozenset(self.normalize_path(path) for path in files)
 
+        self._tracked_cache = (signature, res)
         return res
 
+    def get_tracked_files_signature(self):
+        """
+        A cheap stamp of the tracked files set: changes when HEAD moves or the index is written.
+        """
+        try:
+            head_sha = self.repo.head.commit.hexsha
+        except ValueError:
+            head_sha = None
+
+        try:
+            index_mtime = os.stat(os.path.join(self.repo.git_dir, "index")).st_mtime_ns
+        except FileNotFoundError:
+            index_mtime = None
+
+        return head_sha, index_mtime
+
     def normalize_path(self, path):
-        return str(Path(PurePosixPath((Path(self.root) / path).relative_to(self.root))))
+        return _normalize_path(self.root, path)
 
     def path_in_repo(self, path):
         if not self.repo:
             return
 
-        tracked_files = set(self.get_tracked_files())
-        return self.normalize_path(path) in tracked_files
+        # get_tracked_files returns a cached frozenset, don't copy it on every call
+        return self.normalize_path(path) in self.get_tracked_files()
 
     def abs_root_path(self, path):
-        res = Path(self.root) / path
-        return str(res.resolve())
+        # Not memoized: the result depends on the symlinks on disk, which may change
+        return str((Path(self.root) / path).resolve())
 
     def get_dirty_files(self):
         """
         Returns a list of all files which are dirty (not committed), either staged or in the working
         directory.
         """
-        dirty_files = set()
+        # A single `git status` call reports both the staged and the unstaged changes;
+        # don't let it refresh and rewrite the index on the way
+        status = self.repo.git.execute(
+            ["git", "--no-optional-locks", "status", "--porcelain", "-z", "--untracked-files=no"],
+            strip_newline_in_stdout=False,
+        )
 
-        # Get staged files
-        staged_files = self.repo.git.diff("--name-only", "--cached").splitlines()
-        dirty_files.update(staged_files)
-
-        # Get unstaged files
-        unstaged_files = self.repo.git.diff("--name-only").splitlines()
-        dirty_files.update(unstaged_files)
+        dirty_files = set()
+        entries = iter(status.split("\0"))
+        for entry in entries:
+            if not entry:
+                continue
+            # Each entry is "XY path", X for the index and Y for the working tree
+            dirty_files.add(entry[3:])
+            if "R" in entry[:2] or "C" in entry[:2]:
+                # Renames and copies are followed by the original path
+                next(entries, None)
 
         return list(dirty_files)
 
@@ -80,3 +116,9 @@ class GitRepo:
             return True
 
         return self.repo.is_dirty(path=path)
+
+
+@lru_cache(maxsize=4096)
+def _normalize_path(root, path):
+    # A pure path computation, requested for the same few files over and over
+    return str(Path(PurePosixPath((Path(root) / path).relative_to(root))))
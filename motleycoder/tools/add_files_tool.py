@@ -1,3 +1,5 @@
+from concurrent.futures import ThreadPoolExecutor
+
 from langchain_core.pydantic_v1 import BaseModel, Field
 from langchain_core.tools import StructuredTool
 from motleycrew.common import logger
@@ -31,15 +33,22 @@ class AddFilesTool(MotleyTool):
         super().__init__(langchain_tool)
 
     def add_files(self, files: list[str]):
-        added_files = []
-        for file in files:
-            if not self.user_interface.confirm(f"Add {file} to the list of modifiable files?"):
-                continue
-
-            abs_filename = self.file_group.abs_root_path(file)
+        # Ask once for all the files (file by file if that is rejected), then read them concurrently
+        approved_files = self.user_interface.confirm_many(
+            files, "Add {items} to the list of modifiable files?"
+        )
+        abs_filenames = [self.file_group.abs_root_path(file) for file in approved_files]
+        for abs_filename in abs_filenames:
             logger.info(f"Trying to add to the list of modifiable files: {abs_filename}")
 
-            content = self.read_text_file(abs_filename)
+        if len(abs_filenames) > 1:
+            with ThreadPoolExecutor(max_workers=min(8, len(abs_filenames))) as executor:
+                contents = list(executor.map(self.read_text_file, abs_filenames))
+        else:
+            contents = [self.read_text_file(abs_filename) for abs_filename in abs_filenames]
+
+        added_files = []
+        for file, abs_filename, content in zip(approved_files, abs_filenames, contents):
             if content is None:
                 logger.error(f"Error reading {abs_filename}, skipping it.")
                 continue
@@ -1,6 +1,9 @@
+import threading
 import traceback
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import TYPE_CHECKING, Optional
+from typing import TYPE_CHECKING, Dict, List, Optional
 
 from langchain_core.pydantic_v1 import BaseModel, Field
 from langchain_core.tools import StructuredTool
@@ -25,6 +28,9 @@ class FileEditToolInput(BaseModel):
 
 
 class FileEditTool(MotleyTool):
+    # How many applied edits to remember for skipping repeated calls
+    MAX_EDIT_RESULTS = 64
+
     def __init__(
         self,
         file_group: FileGroup,
@@ -33,7 +39,14 @@ class FileEditTool(MotleyTool):
         prompts: Optional[MotleyCoderPrompts] = None,
         linter: Optional[Linter] = None,
         name: str = "edit_file",
+        defer_lint: bool = False,
     ):
+        """
+        :param defer_lint: return as soon as the edit is written, and lint in the background;
+            the lint errors are then reported with the result of the next edit,
+            or collected with collect_lint_errors at the end of the turn
+            (ReturnToUserTool does that when given this tool, and then calls close()).
+        """
         # TODO: replace coder with specific components
         self.file_group = file_group
         self.user_interface = user_interface
@@ -41,6 +54,15 @@ class FileEditTool(MotleyTool):
 
         self.prompts = prompts
         self.linter = linter
+        self._bookkeeping_lock = threading.Lock()
+
+        self.defer_lint = defer_lint
+        # Started on the first deferred lint, so an idle tool holds no thread
+        self._lint_executor: ThreadPoolExecutor | None = None
+        self._pending_lints: Dict[str, Future] = {}
+
+        # The results of the applied edits, with the stamp of the file they left behind
+        self._edit_results: OrderedDict[tuple, tuple[tuple | None, str]] = OrderedDict()
 
         langchain_tool = StructuredTool.from_function(
             func=self.edit_file,
@@ -51,14 +73,112 @@ class FileEditTool(MotleyTool):
         super().__init__(langchain_tool)
 
     def edit_file(self, file_path: str, language: str, search: str, replace: str) -> str:
-        error_message = self.edit_file_inner(file_path, search, replace)
+        # Models sometimes repeat a tool call: if the file is still as the same edit left it,
+        # repeating the edit can only give the same result, so don't apply it again
+        key = (file_path, search, replace)
+        previous = self._edit_results.get(key)
+        if previous is not None and previous[0] == self.file_stamp(file_path):
+            return previous[1]
+
+        # If linting is deferred, the errors found after the previous edits come with this one
+        lint_errors = self.collect_lint_errors()
+
+        applied, result = self._edit_file_result(file_path, search, replace)
+        if applied:
+            # Failures aren't remembered: eg the user may allow adding the file next time
+            self._edit_results[key] = (self.file_stamp(file_path), result)
+            self._edit_results.move_to_end(key)
+            if len(self._edit_results) > self.MAX_EDIT_RESULTS:
+                self._edit_results.popitem(last=False)
+
+        if lint_errors:
+            result += "\n\n" + lint_errors
+        return result
+
+    def close(self):
+        """
+        Wait for the deferred lints to finish and stop the background linting thread.
+        The tool stays usable: the next deferred lint starts a new thread.
+        """
+        with self._bookkeeping_lock:
+            executor, self._lint_executor = self._lint_executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def reset_turn(self):
+        """Forget the results of the previous edits, eg at the start of an agent turn."""
+        self._edit_results.clear()
+
+    def file_stamp(self, file_path: str) -> tuple | None:
+        try:
+            return self.file_group.content_stamp(self.file_group.abs_root_path(file_path))
+        except FileNotFoundError:
+            return None
+
+    def edit_file_result(self, file_path: str, search: str, replace: str) -> str:
+        return self._edit_file_result(file_path, search, replace)[1]
+
+    def _edit_file_result(self, file_path: str, search: str, replace: str) -> tuple[bool, str]:
+        """:return: whether the edit was applied, and the result message"""
+        applied, error_message = self._edit_file_inner(file_path, search, replace)
         if error_message:  # TODO: max_reflections
-            return error_message
+            return applied, error_message
 
         if self.prompts:
-            return self.prompts.file_edit_success.format(file_path=file_path)
+            return applied, self.prompts.file_edit_success.format(file_path=file_path)
 
-        return f"Successfully edited file {file_path}."
+        return applied, f"Successfully edited file {file_path}."
+
+    def collect_lint_errors(self) -> str | None:
+        """
+        Wait for the deferred lints to finish, and return the errors the user wants fixed.
+        """
+        with self._bookkeeping_lock:
+            pending, self._pending_lints = self._pending_lints, {}
+
+        all_errors = []
+        for file_path, future in pending.items():
+            errors = self.confirm_lint_errors(file_path, future.result())
+            if errors:
+                all_errors.append(errors)
+        return "\n\n".join(all_errors) if all_errors else None
+
+    def lint_file(self, file_path: str) -> str | None:
+        errors = self.linter.lint(self.file_group.abs_root_path(file_path))
+        return self.confirm_lint_errors(file_path, errors)
+
+    def confirm_lint_errors(self, file_path: str, errors: str | None) -> str | None:
+        if errors:
+            logger.error(f"Lint errors in {file_path}: {errors}")
+            if self.user_interface.confirm("Attempt to fix lint errors?"):
+                return errors
+
+    def edit_files(self, edits: List[FileEditToolInput | dict]) -> List[str]:
+        """
+        Apply several edits at once, eg all the edit_file calls of an assistant turn.
+        Edits to different files are independent, so they run concurrently (linting included);
+        the edits to each file run in their original order.
+        :return: the result of each edit, in the order of the edits
+        """
+        edits = [edit if isinstance(edit, dict) else edit.dict() for edit in edits]
+        indices_by_file = defaultdict(list)
+        for i, edit in enumerate(edits):
+            indices_by_file[self.file_group.abs_root_path(edit["file_path"])].append(i)
+
+        results = [None] * len(edits)
+
+        def edit_one_file(indices: List[int]):
+            for i in indices:
+                results[i] = self.edit_file(**edits[i])
+
+        if len(indices_by_file) > 1:
+            with ThreadPoolExecutor(max_workers=min(8, len(indices_by_file))) as executor:
+                # list() to re-raise any exception from the workers
+                list(executor.map(edit_one_file, indices_by_file.values()))
+        else:
+            for indices in indices_by_file.values():
+                edit_one_file(indices)
+        return results
 
     def prepare_file_for_edit(self, file_path: str):
         abs_path = self.file_group.abs_root_path(file_path)
@@ -78,14 +198,17 @@ class FileEditTool(MotleyTool):
             Path(abs_path).touch()
 
     def invalidate_tag_graphs(self, file_path: str):
-        if not self.repo_map.tag_graphs:
-            return
+        # The cached graphs are keyed by absolute file names, as listed by the file group
+        abs_path = self.file_group.abs_root_path(file_path).replace("\\", "/")
+        self.repo_map.invalidate_tag_graphs(abs_path)
 
-        for files, graph in self.repo_map.tag_graphs.copy().items():
-            if file_path in files:
-                self.repo_map.tag_graphs.pop(files)
+    def edit_file_inner(self, file_path: str, search: str, replace: str) -> str | None:
+        return self._edit_file_inner(file_path, search, replace)[1]
 
-    def edit_file_inner(self, file_path: str, search: str, replace: str) -> str:
+    def _edit_file_inner(
+        self, file_path: str, search: str, replace: str
+    ) -> tuple[bool, str | None]:
+        """:return: whether the edit was applied, and the error message or lint errors if any"""
         if not search or search[-1] != "\n":
             search += "\n"
         if not replace or replace[-1] != "\n":
@@ -103,7 +226,7 @@ class FileEditTool(MotleyTool):
             self.prepare_file_for_edit(file_path)
         except Exception as err:
             logger.error(f"Error preparing file for edit: {err}")
-            return "Cannot edit file: " + str(err)
+            return False, "Cannot edit file: " + str(err)
 
         try:
             # self.coder.dirty_commit()  # Add the file to the repo if it's not already there
@@ -114,7 +237,7 @@ class FileEditTool(MotleyTool):
             logger.warning(str(err))
 
             traceback.print_exc()
-            return str(err)
+            return False, str(err)
 
         if not result:
             res = (
@@ -126,17 +249,27 @@ class FileEditTool(MotleyTool):
                     f"\nDid you mean to match some of these actual lines from {file_path}?\n"
                     f"```\n{close_match}\n```"
                 )
-            return res
+            return False, res
 
-        self.file_group.edited_files.add(file_path)
-        self.invalidate_tag_graphs(file_path)
+        # Edits to different files can run concurrently, see edit_files
+        with self._bookkeeping_lock:
+            self.file_group.edited_files.add(file_path)
+            self.invalidate_tag_graphs(file_path)
 
         if self.linter:
-            errors = self.linter.lint(self.file_group.abs_root_path(file_path))
-            if errors:
-                logger.error(f"Lint errors in {file_path}: {errors}")
-                if self.user_interface.confirm("Attempt to fix lint errors?"):
-                    return errors
+            if not self.defer_lint:
+                return True, self.lint_file(file_path)
+
+            with self._bookkeeping_lock:
+                if self._lint_executor is None:
+                    self._lint_executor = ThreadPoolExecutor(max_workers=1)
+                future = self._lint_executor.submit(
+                    self.linter.lint, self.file_group.abs_root_path(file_path)
+                )
+                # A newer lint of the same file makes the pending one stale
+                self._pending_lints[file_path] = future
+
+        return True, None
 
 
 if __name__ == "__main__":
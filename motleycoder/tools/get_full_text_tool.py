@@ -8,6 +8,7 @@ from motleycrew.common import logger
 from motleycrew.tools import MotleyTool
 
 from aider.codemap.repomap import RepoMap
+from motleycoder.codemap.graph import normalize_entity_name
 from aider.codemap.render import RenderCode
 from aider.codemap.tag import Tag
 
@@ -53,7 +54,7 @@ class GetFullTextTool(MotleyTool):
         if entity_name is None:
             return "Please make sure to supply an entity name as an input to this tool"
 
-        entity_name = entity_name.replace("()", "")
+        entity_name = normalize_entity_name(entity_name)
 
         if (entity_name, file_name) in self.requested_tags:
             return "You've already requested that one!"
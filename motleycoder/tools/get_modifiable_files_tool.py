@@ -25,5 +25,5 @@ class GetModifiableFilesTool(MotleyTool):
         self.file_group = file_group
 
     def get_modifiable_files(self) -> List[str]:
-        files = self.file_group.files_for_modification
+        files = self.file_group.sorted_files_for_modification
         return [self.file_group.get_rel_fname(file) for file in files]
@@ -1,13 +1,17 @@
-import os.path
-from collections import deque
-from pathlib import Path
-from typing import Optional
+import itertools
+import os
+import stat
+from collections import OrderedDict
+from functools import partial
+from typing import List, Optional, Set
 
 from langchain_core.pydantic_v1 import BaseModel, Field
 from langchain_core.tools import StructuredTool
 
 from motleycoder.codemap.file_group import FileGroup
+from motleycoder.codemap.graph import TagGraph, normalize_entity_name
 from motleycoder.codemap.repomap import RepoMap
+from motleycoder.codemap.tag import Tag
 from motleycoder.repo import GitRepo
 from motleycrew.tools import MotleyTool
 
@@ -33,7 +37,9 @@ class InspectEntityTool(MotleyTool):
         self.max_lines_long = max_lines_long
         self.max_lines_short = max_lines_short
 
-        self.requested_tags = deque(maxlen=block_identical_calls)
+        # The most recent requests, oldest first; a dict for O(1) membership checks
+        self.block_identical_calls = block_identical_calls
+        self.requested_tags: OrderedDict[tuple, None] = OrderedDict()
 
         langchain_tool = StructuredTool.from_function(
             func=self.get_object_summary,
@@ -62,7 +68,7 @@ class InspectEntityTool(MotleyTool):
             return "Please supply either the file name or the entity name"
 
         if entity_name is not None:
-            entity_name = entity_name.strip().replace("()", "")
+            entity_name = normalize_entity_name(entity_name)
 
         if (entity_name, file_name) in self.requested_tags:
             return (
@@ -70,38 +76,62 @@ class InspectEntityTool(MotleyTool):
                 "Please use existing information or request a different entity."
             )
         else:
-            self.requested_tags.append((entity_name, file_name))
+            self.requested_tags[(entity_name, file_name)] = None
+            while len(self.requested_tags) > self.block_identical_calls:
+                self.requested_tags.popitem(last=False)
 
         tag_graph = self.repo_map.get_tag_graph(with_tests=True)
 
         if not entity_name:
             abs_file_path = self.repo_map.file_group.abs_root_path(file_name)
             try:
-                file_content = Path(abs_file_path).read_text()
+                # Served from memory while the file is unchanged on disk
+                file_content = self.repo_map.file_group.read_file_content(abs_file_path)
             except FileNotFoundError:
                 return f"File {file_name} not found in the repo"
             except IsADirectoryError:
                 files = self.repo_map.file_group.get_rel_fnames_in_directory(
                     abs_file_path, level=None, with_tests=True
                 )
-                return f"{file_name} is a directory. Files in it:\n{"\n".join(sorted(files))}"
+                return f"{file_name} is a directory. Files in it:\n{"\n".join(files)}"
 
             if not file_content:
                 return f"File {file_name} is empty"
 
-            return tag_graph.get_file_representation(
-                file_name=abs_file_path,
-                file_content=file_content,
+            # The cached content is the same str object every time, so its hash is computed once
+            key = (type(self).__name__, abs_file_path, file_content)
+            return self.repo_map.get_cached_tool_output(
+                tag_graph,
+                key,
+                partial(
+                    tag_graph.get_file_representation,
+                    file_name=abs_file_path,
+                    file_content=file_content,
+                ),
             )
 
+        # Rendering an entity is the expensive part, reuse it while the tag graph is unchanged
+        key = (
+            type(self).__name__,
+            entity_name,
+            file_name,
+            self.show_other_files,
+            self.max_lines_long,
+            self.max_lines_short,
+        )
+        return self.repo_map.get_cached_tool_output(
+            tag_graph, key, partial(self._get_entity_summary, tag_graph, entity_name, file_name)
+        )
+
+    def _get_entity_summary(
+        self, tag_graph: TagGraph, entity_name: str, file_name: Optional[str]
+    ) -> str:
         out = ""
 
         # TODO: if file_name is a directory, just list the files in it?
-        re_tags = tag_graph.get_tags_from_entity_name(entity_name, file_name)
-        if not len(re_tags) and entity_name is not None and "." in entity_name:
-            entity_name_short = entity_name.split(".")[-1]
-            out += f"Entity {entity_name} not found, searching for {entity_name_short}...\n"
-            re_tags = tag_graph.get_tags_from_entity_name(entity_name_short, file_name)
+        re_tags, matched_as = tag_graph.get_tags_from_entity_name_or_suffix(entity_name, file_name)
+        if matched_as != entity_name:
+            out += f"Entity {entity_name} not found, searching for {matched_as}...\n"
 
         if not re_tags:  # maybe it was an explicit import?
             if entity_name is not None:
@@ -110,10 +140,11 @@ class InspectEntityTool(MotleyTool):
                     f"You can specify the entity name more broadly or omit it "
                     f"for reading the whole file."
                 )
-                if file_name is None or self.to_dir(file_name) is None:
+                file_dir = self.to_dir(file_name) if file_name is not None else None
+                if file_dir is None:
                     return out  # Absolutely no directories to work with
                 else:
-                    candidate_dirs = [self.to_dir(file_name)]
+                    candidate_dirs = [file_dir]
             else:
                 return f"File {file_name} not found in the repo"
 
@@ -131,22 +162,26 @@ class InspectEntityTool(MotleyTool):
                 for t in re_tags
             ]
             out += "\n".join(repr_parts)
-            candidate_dirs = [self.to_dir(t.fname) for t in re_tags]
+            candidate_dirs = self.to_dirs(re_tags)
         else:  # Can get multiple tags eg when requesting a whole file
             # TODO: this could be neater
-            repr_parts = [
-                tag_graph.get_tag_representation(
+            # Stop rendering as soon as the joined representations get too long
+            repr_parts = []
+            n_lines = 0
+            for t in re_tags:
+                part = tag_graph.get_tag_representation(
                     t, parent_details=False, max_lines=self.max_lines_short
                 )
-                for t in re_tags
-            ]
-            repr = "\n".join(repr_parts)
+                repr_parts.append(part)
+                n_lines += part.count("\n") + 1
+                if n_lines >= self.max_lines_long:
+                    break
 
-            if len(repr.split("\n")) < self.max_lines_long:
-                out += repr
+            if n_lines < self.max_lines_long:
+                out += "\n".join(repr_parts)
             else:
                 repr = tag_graph.code_renderer.to_tree(re_tags)
-                if len(repr.split("\n")) < self.max_lines_long:
+                if repr.count("\n") + 1 < self.max_lines_long:
                     out += repr
                 else:
                     fnames = sorted(list(set(t.rel_fname for t in re_tags)))
@@ -158,29 +193,39 @@ class InspectEntityTool(MotleyTool):
                     )
                     out += "\n".join(fnames)
 
-            candidate_dirs = list(set([self.to_dir(t.fname) for t in re_tags]))
+            candidate_dirs = self.to_dirs(re_tags)
 
         files = set(
-            sum(
-                [self.repo_map.file_group.get_rel_fnames_in_directory(d, with_tests=True) for d in candidate_dirs],
-                [],
+            itertools.chain.from_iterable(
+                self.repo_map.file_group.get_rel_fnames_in_directory(d, with_tests=True)
+                for d in candidate_dirs
             )
         )
 
-        mentioned_fnames = set([t.fname for t in re_tags])
+        mentioned_fnames = {t.fname for t in re_tags}
         other_fnames = files - mentioned_fnames
         if other_fnames and self.show_other_files:
             out += "\nOther files in same directory(s):\n" + "\n".join(sorted(list(other_fnames)))
         return out
 
+    def to_dirs(self, tags: List[Tag]) -> Set[str]:
+        # The files of the tags were just checked to exist when the tag graph was fetched,
+        # so their directories don't need a stat call; many tags share a file
+        return {os.path.dirname(fname) for fname in {t.fname for t in tags}}
+
     def to_dir(self, rel_fname: str) -> str:
-        abs_dir = self.repo_map.file_group.abs_root_path(rel_fname)
-        if os.path.isfile(abs_dir):
-            abs_dir = os.path.dirname(abs_dir)
-        if os.path.isdir(abs_dir):
-            return abs_dir
-        else:
+        abs_path = self.repo_map.file_group.abs_root_path(rel_fname)
+        # One stat call tells whether it's a file, a directory or neither
+        try:
+            mode = os.stat(abs_path).st_mode
+        except OSError:
             return None
+        if stat.S_ISDIR(mode):
+            return abs_path
+        if stat.S_ISREG(mode):
+            # The parent of an existing file is an existing directory
+            return os.path.dirname(abs_path)
+        return None
 
 
 if __name__ == "__main__":
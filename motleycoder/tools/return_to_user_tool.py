@@ -4,6 +4,8 @@ from motleycrew.agents import MotleyOutputHandler
 from motleycrew.common import Defaults
 from motleycrew.common.exceptions import InvalidOutput
 
+from motleycoder.codemap.file_group import FileGroup
+from motleycoder.tools.file_edit_tool import FileEditTool
 from motleycoder.user_interface import UserInterface
 
 
@@ -15,17 +17,67 @@ class ReturnToUserTool(MotleyOutputHandler):
         user_interface: UserInterface,
         tests_runner: Optional[Callable] = None,
         max_iterations: int = Defaults.DEFAULT_OUTPUT_HANDLER_MAX_ITERATIONS,
+        file_group: Optional[FileGroup] = None,
+        file_edit_tool: Optional[FileEditTool] = None,
     ):
+        """
+        :param file_group: if given, the tests are only rerun when some of its files have changed
+            since the last run; otherwise the last result is reused
+        :param file_edit_tool: if given, its turn ends here: the lint errors of the last edits
+            (if linting is deferred) are reported before running the tests,
+            its background linting thread is stopped,
+            and the edits it remembers to skip repeated calls are forgotten.
+            Lint rejections count towards max_iterations, like test failures.
+        """
         self.user_interface = user_interface
         self.tests_runner = tests_runner
+        self.file_group = file_group
+        self.file_edit_tool = file_edit_tool
         super().__init__(max_iterations=max_iterations)
 
         self._iteration = 0
+        self._last_run: tuple[tuple, Optional[str]] | None = None
+
+    def files_signature(self) -> tuple | None:
+        if self.file_group is None:
+            return None
+        try:
+            return tuple(
+                (fname, self.file_group.content_stamp(fname))
+                for fname in self.file_group.get_all_filenames(with_tests=True)
+            )
+        except OSError:
+            # A file vanished while we were looking, can't tell what changed
+            return None
+
+    def run_tests(self) -> Optional[str]:
+        signature = self.files_signature()
+        if signature is not None and self._last_run is not None and self._last_run[0] == signature:
+            return self._last_run[1]
+
+        out = self.tests_runner()
+        self._last_run = (signature, out) if signature is not None else None
+        return out
 
     def handle_output(self):
+        lint_errors = None
+        if self.file_edit_tool is not None:
+            lint_errors = self.file_edit_tool.collect_lint_errors()
+            self.file_edit_tool.close()
+            self.file_edit_tool.reset_turn()
+
         self._iteration += 1
 
-        out = self.tests_runner()
+        if lint_errors:
+            if self._iteration >= self.max_iterations:
+                self._iteration = 0
+                return (
+                    "Maximum output handler iterations exceeded. "
+                    "Lint errors remain in the last edits:\n" + lint_errors
+                )
+            raise InvalidOutput("Lint errors found in the last edits:\n" + lint_errors)
+
+        out = self.run_tests()
         if out is None:
             self._iteration = 0
             return "Tests passed!"
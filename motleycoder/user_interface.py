@@ -1,14 +1,54 @@
+import re
+import threading
+from typing import Iterable
+
 from motleycrew.common import logger
 
 class UserInterface:
-    def __init__(self, yes: bool = False):
+    def __init__(
+        self,
+        yes: bool = False,
+        remember_answers: bool = False,
+        auto_approve: Iterable[str] = (),
+    ):
+        """
+        :param yes: approve everything without asking
+        :param remember_answers: ask each distinct question only once per session,
+            eg when the agent keeps retrying the same failing tests
+        :param auto_approve: regexes of the questions to approve without asking
+        """
         self.yes = yes
+        self.remember_answers = remember_answers
+        self.auto_approve = [re.compile(pattern) for pattern in auto_approve]
+        self._answers: dict[str, bool] = {}
+        # Tools may run concurrently: ask one question at a time
+        self._lock = threading.Lock()
 
     def confirm(self, message: str) -> bool:
-        if self.yes:
+        if self.yes or any(pattern.search(message) for pattern in self.auto_approve):
             approved = True
         else:
-            approved = input(f"{message} [y/n] ").lower().startswith("y")
+            with self._lock:
+                approved = self._answers.get(message) if self.remember_answers else None
+                if approved is None:
+                    approved = input(f"{message} [y/n] ").lower().startswith("y")
+                    if self.remember_answers:
+                        self._answers[message] = approved
 
         logger.info(f"{message} {"approved" if approved else "rejected"}")
         return approved
+
+    def confirm_many(self, items: list[str], message: str) -> list[str]:
+        """
+        Ask a single confirmation for several items at once;
+        if it is rejected, ask for each item in turn, so that some of them can still be approved.
+        :param message: the question, formatted with the comma-separated items as {items}
+        :return: the approved items
+        """
+        if not items:
+            return []
+        if self.confirm(message.format(items=", ".join(items))):
+            return list(items)
+        if len(items) == 1:
+            return []
+        return [item for item in items if self.confirm(message.format(items=item))]